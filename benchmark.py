@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Time rostermangler's parse, family build, reconcile and render stages on synthetic exports."""
+
+import sys
+import os
+import io
+import csv
+import json
+import random
+import zipfile
+import argparse
+import tempfile
+import time
+import tracemalloc
+from xml.sax.saxutils import escape
+
+import rostermangler
+
+FIRST_NAMES = ["Ann", "Bob", "Cal", "Dee", "Eve", "Fay", "Gus", "Hal", "Ida", "Jon", "Kim", "Lea", "Max", "Ned",
+               "Ola", "Pat", "Quin", "Rae", "Sam", "Tia", "Uma", "Vic", "Wes", "Xia", "Yul", "Zoe"]
+CITIES = ["Pasadena", "Altadena", "Sierra Madre", "La Canada", "Monrovia", "Arcadia"]
+ROLES = ["Club Leader", "Project Leader", "Community Club Leader", "Resource Leader", "Volunteer"]
+# Extra columns found in real exports that the parser never reads
+EXTRA_MEMBER_COLUMNS = ["Member: Grade", "Member: Gender", "Member: Years in 4-H", "Member: Shirt Size"]
+ADULT_COLUMNS = ["Name", "Email", "Role", "Phone", "Status", "City"]
+WORDPRESS_COLUMNS = ["Email", "Activated?", "Choose a Username"]
+MAILCHIMP_COLUMNS = ["Email Address", "First Name", "Last Name"]
+STAGES = ("parse", "build", "reconcile", "render", "user_update")
+ODS_HEADER = '<?xml version="1.0" encoding="UTF-8"?>' \
+             '<office:document-content xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" ' \
+             'xmlns:table="urn:oasis:names:tc:opendocument:xmlns:table:1.0" ' \
+             'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0">' \
+             '<office:body><office:spreadsheet>'
+ODS_FOOTER = '</office:spreadsheet></office:body></office:document-content>'
+
+
+def ods_cell(value):
+    "ODS XML for one cell"
+    if value == "":
+        return "<table:table-cell/>"
+    if isinstance(value, int):
+        return f'<table:table-cell office:value-type="float" office:value="{value}"><text:p>{value}</text:p>' \
+               '</table:table-cell>'
+    return f'<table:table-cell office:value-type="string"><text:p>{escape(value)}</text:p></table:table-cell>'
+
+
+def write_ods_sheet(out, name, rows):
+    "Write one sheet with the trailing padding LibreOffice adds to exports"
+    out.write(f'<table:table table:name="{name}">'.encode())
+    for row in rows:
+        out.write(("<table:table-row>" + "".join(ods_cell(v) for v in row) +
+                   '<table:table-cell table:number-columns-repeated="1000"/></table:table-row>').encode())
+    out.write(b'<table:table-row table:number-rows-repeated="1048000">'
+              b'<table:table-cell table:number-columns-repeated="1024"/></table:table-row></table:table>')
+
+
+def synthetic_households(num_members, seed=0):
+    """Generate (parents, children) households totalling about num_members children.
+    Includes siblings, parents shared between households, blank second parents and conflicting emails."""
+    rand = random.Random(seed)
+    households = []
+    members = 0
+    while members < num_members:
+        last = f"{rand.choice(FIRST_NAMES)}{len(households)}"
+        email = f"{last.lower()}@example.com"
+        phone = f"626-555-{rand.randrange(10000):04d}"
+        parents = [(rand.choice(FIRST_NAMES), last, email, phone)]
+        if rand.random() < 0.6:
+            parents.append((rand.choice(FIRST_NAMES), last if rand.random() < 0.7 else f"Other{members}",
+                            email if rand.random() < 0.5 else f"p2.{members}@example.com", phone))
+        elif households and rand.random() < 0.1:
+            # Blended family, a parent already seen with another household
+            parents.append(rand.choice(households)[0][0])
+        children = []
+        for i in range(rand.choice((1, 1, 1, 2, 2, 3))):
+            children.append((f"{rand.choice(FIRST_NAMES)}{i}", last,
+                             email if rand.random() < 0.8 else f"kid{members}.{i}@example.com",
+                             phone, f"{rand.randrange(1000)} Main St", rand.choice(CITIES), rand.randrange(5, 19)))
+        households.append((parents, children))
+        members += len(children)
+    return households
+
+
+def write_synthetic_exports(directory, num_members, seed=0):
+    """Write export.ods, members.csv, mailchimp.csv and wordpress.csv for a club of about num_members.
+    Returns the paths by name"""
+    rand = random.Random(seed)
+    households = synthetic_households(num_members, seed)
+    keys = list(rostermangler.MEMBER_COLUMNS) + EXTRA_MEMBER_COLUMNS
+    col = {k: i for i, k in enumerate(keys)}
+    paths = {name: os.path.join(directory, name)
+             for name in ("export.ods", "members.csv", "mailchimp.csv", "wordpress.csv")}
+    emails = set()
+
+    def member_rows():
+        "Members sheet rows"
+        yield keys
+        for parents, children in households:
+            for first, last, email, phone, address, city, age in children:
+                row = [""] * len(keys)
+                row[col["Member: First Name"]], row[col["Member: Last Name"]] = first, last
+                row[col["Member: Email"]], row[col["Member: Primary Phone"]] = email, phone
+                row[col["Family: Address"]], row[col["Family: City"]] = address, city
+                row[col["Member: Age"]] = age
+                row[col["Member: Parent 1 First Name"]], row[col["Member: Parent 1 Last Name"]] = parents[0][:2]
+                row[col["Family: Family Email"]], row[col["Member: Parent 1 Cell Phone"]] = parents[0][2:]
+                if len(parents) > 1:
+                    row[col["Member: Parent 2 First Name"]], row[col["Member: Parent 2 Last Name"]] = parents[1][:2]
+                    row[col["Member: Parent 2 Email"]] = parents[1][2]
+                    row[col["Member: Parent 2 Home Phone"]] = parents[1][3]
+                row[col["Member: Grade"]] = str(max(age - 5, 0))
+                emails.update((email, parents[0][2]))
+                # Some exports leave off trailing columns entirely
+                if rand.random() < 0.05:
+                    del row[col["Member: Parent 2 First Name"]:]
+                yield row
+
+    def adult_rows():
+        "Adult Volunteers sheet rows, drawn from the parents"
+        yield ADULT_COLUMNS
+        for parents, _ in households:
+            if rand.random() < 0.2:
+                first, last, email, phone = parents[0]
+                yield [f"{last}, {first}", email, rand.choice(ROLES), phone, "Active",
+                       f"{rand.choice(CITIES)}, CA"]
+
+    with zipfile.ZipFile(paths["export.ods"], "w", zipfile.ZIP_DEFLATED) as book:
+        book.writestr("mimetype", "application/vnd.oasis.opendocument.spreadsheet")
+        with book.open("content.xml", "w") as out:
+            out.write(ODS_HEADER.encode())
+            write_ods_sheet(out, "Members", member_rows())
+            write_ods_sheet(out, "Adult Volunteers", adult_rows())
+            out.write(ODS_FOOTER.encode())
+    with open(paths["members.csv"], "wt", newline="") as fh:
+        writer = csv.writer(fh)
+        for row in member_rows():
+            writer.writerow(row)
+    emails = sorted(emails)
+    with open(paths["mailchimp.csv"], "wt", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(MAILCHIMP_COLUMNS)
+        for email in emails:
+            if rand.random() < 0.9:
+                writer.writerow([email.upper() if rand.random() < 0.05 else email, "", ""])
+        for i in range(len(emails) // 20):
+            writer.writerow([f"former{i}@example.com", "", ""])
+    with open(paths["wordpress.csv"], "wt", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(WORDPRESS_COLUMNS)
+        for email in emails:
+            if rand.random() < 0.8:
+                writer.writerow([email, "yes", email.split("@")[0]])
+        for i in range(len(emails) // 20):
+            writer.writerow([f"gone{i}@example.com", "yes", f"gone{i}"])
+    return paths
+
+
+def measure(func, *args, memory=True):
+    """Run func, returning its result and its wall seconds, CPU seconds and peak traced MiB.
+    Tracing slows python down several times, so peak memory comes from a second, traced, run."""
+    wall, cpu = time.perf_counter(), time.process_time()
+    result = func(*args)
+    stats = {"seconds": round(time.perf_counter() - wall, 4), "cpu_seconds": round(time.process_time() - cpu, 4)}
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args)
+            stats["peak_mib"] = round(tracemalloc.get_traced_memory()[1] / (1 << 20), 2)
+        finally:
+            tracemalloc.stop()
+    return result, stats
+
+
+def run_benchmark(num_members, work_dir, seed=0, memory=True):
+    "Time every stage on a synthetic club of about num_members, returning stage results by name"
+    paths = write_synthetic_exports(work_dir, num_members, seed)
+    results = {}
+    book, results["parse"] = measure(rostermangler.read_sheets, paths["export.ods"],
+                                     {"Members": rostermangler.MEMBER_COLUMNS, "Adult Volunteers": None},
+                                     memory=memory)
+
+    def build():
+        "Family build from the parsed rows"
+        members, adults = book["Members"], book["Adult Volunteers"]
+        builder = rostermangler.FamilyBuilder()
+        rostermangler.get_members_as_families(members[1:], rostermangler.keys_row_to_keys_dict(members[0]),
+                                              builder)
+        for adult in rostermangler.get_adult_volunteers_as_people(
+                adults[1:], rostermangler.keys_row_to_keys_dict(adults[0])):
+            builder.add_parent(adult)
+        return builder.families
+    families, results["build"] = measure(build, memory=memory)
+
+    def reconcile():
+        "Mailchimp reconciliation against the built families"
+        with open(paths["mailchimp.csv"], "rt") as mailchimp_export:
+            return rostermangler.merge_families(families, mailchimp_export, output_dir=work_dir)
+    _, results["reconcile"] = measure(reconcile, memory=memory)
+
+    def render():
+        "HTML roster of the built families"
+        out = io.StringIO()
+        rostermangler.write_roster(sorted(families, key=lambda fam: fam.family_name), out, full_html=True)
+        return out.tell()
+    _, results["render"] = measure(render, memory=memory)
+    _, results["user_update"] = measure(rostermangler.user_update, paths["wordpress.csv"], paths["members.csv"],
+                                        os.path.join(work_dir, "new_users.csv"),
+                                        os.path.join(work_dir, "remove_users.csv"), memory=memory)
+    results["families"] = len(families)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    "List the stages slower than baseline, or with a higher peak memory when both runs have it, by more than tolerance"
+    regressions = []
+    for size, stages in results.items():
+        for stage in STAGES:
+            old = baseline.get(size, {}).get(stage)
+            if not old:
+                continue
+            new = stages[stage]
+            if new["seconds"] > old["seconds"] * (1 + tolerance):
+                regressions.append(f"{size} members {stage}: {new['seconds']:.3f}s, baseline {old['seconds']:.3f}s")
+            if "peak_mib" in new and "peak_mib" in old and new["peak_mib"] > old["peak_mib"] * (1 + tolerance):
+                regressions.append(f"{size} members {stage}: {new['peak_mib']:.1f} MiB peak, "
+                                   f"baseline {old['peak_mib']:.1f} MiB")
+    return regressions
+
+
+def main():
+    "Program entry point"
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("sizes", nargs="*", type=int, default=[100, 1000, 10000],
+                        help="Approximate number of members per synthetic club")
+    parser.add_argument("--baseline", help="JSON file of earlier results to compare against")
+    parser.add_argument("--save", help="Write results as JSON, e.g. to become the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slow down before failing")
+    parser.add_argument("--keep", help="Write the synthetic exports to this directory and keep them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no_memory", action="store_true", help="Skip the traced runs that measure peak memory")
+    args = parser.parse_args()
+    results = {}
+    for size in args.sizes:
+        if args.keep:
+            work_dir = os.path.join(args.keep, str(size))
+            os.makedirs(work_dir, exist_ok=True)
+            results[str(size)] = run_benchmark(size, work_dir, args.seed, not args.no_memory)
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                results[str(size)] = run_benchmark(size, work_dir, args.seed, not args.no_memory)
+        stages = results[str(size)]
+        print(f"{size} members, {stages['families']} families", file=sys.stderr)
+        for stage in STAGES:
+            peak = f"{stages[stage]['peak_mib']:>10.1f} MiB" if "peak_mib" in stages[stage] else ""
+            print(f"    {stage:<12}{stages[stage]['seconds']:>10.3f}s{peak}", file=sys.stderr)
+    if args.save:
+        with open(args.save, "wt") as fh:
+            json.dump(results, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline, "rt") as fh:
+            regressions = compare(results, json.load(fh), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,15 +3,127 @@
 
 import sys
 import os
+import io
+import re
 import csv
-import pyexcel_ods
+import operator
+import json
+import base64
+import random
+import hashlib
+import pickle
 import collections
 import argparse
+import time
+import contextlib
+import functools
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def intern_str(value):
+    "Intern strings so that values repeated across many rows share one object"
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Stats:
+    "Per stage timings and event counters for a run, only collected when enabled"
+
+    def __init__(self):
+        "Initalize empty, disabled, statistics"
+        self.enabled = False
+        self.stages = {}
+        self.counters = collections.Counter()
+        self._nested = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        "Time a block as a pipeline stage. Time spent in stages nested inside is not counted again"
+        if not self.enabled:
+            yield
+            return
+        self._nested.append([0.0, 0.0])
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            nested_wall, nested_cpu = self._nested.pop()
+            if self._nested:
+                self._nested[-1][0] += wall
+                self._nested[-1][1] += cpu
+            totals = self.stages.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+            totals["wall_seconds"] += wall - nested_wall
+            totals["cpu_seconds"] += cpu - nested_cpu
+            totals["calls"] += 1
+
+    def timed(self, name):
+        "Decorator timing every call of a function as a stage"
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def timed_iter(self, name, iterable):
+        "Time the work done producing the items of an iterable as a stage"
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name, n=1):
+        "Add to an event counter"
+        if self.enabled:
+            self.counters[name] += n
+
+    @staticmethod
+    def peak_memory_mib():
+        "Peak resident memory of this process in MiB, if the platform can tell"
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+    def as_dict(self):
+        "Statistics as plain data for JSON"
+        return {"stages": self.stages, "counters": dict(self.counters), "peak_memory_mib": self.peak_memory_mib()}
+
+    def summary(self):
+        "Human readable statistics"
+        lines = [f"{'Stage':<24}{'Wall s':>10}{'CPU s':>10}{'Calls':>8}"]
+        for name, totals in sorted(self.stages.items(), key=lambda item: -item[1]["wall_seconds"]):
+            lines.append(f"{name:<24}{totals['wall_seconds']:>10.3f}{totals['cpu_seconds']:>10.3f}"
+                         f"{totals['calls']:>8}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<24}{value:>10}")
+        peak = self.peak_memory_mib()
+        if peak is not None:
+            lines.append(f"{'peak memory MiB':<24}{peak:>10.1f}")
+        return os.linesep.join(lines) + os.linesep
+
+
+STATS = Stats()
 
 
 class Person:
     "Structure for data about a single member or volunteer"
+    __slots__ = ("first_name", "last_name", "phone", "email", "age", "nickname", "role", "address", "city")
     MIN_AGE = 5
+    # Incremented by every update so that families can tell when their cached values are stale
+    revision = 0
 
     def __init__(self, first_name="", last_name="", last_name_first_name=None, phone="", email="", age=0,
                  nickname=None, role=None, address=None, city=None):
@@ -21,16 +133,17 @@ class Person:
         else:
             self.first_name = first_name.strip()
             self.last_name = last_name.strip()
-        self.phone = phone.strip()
-        self.email = email.lower().strip()
+        self.last_name = intern_str(self.last_name)
+        self.phone = intern_str(phone.strip())
+        self.email = intern_str(email.lower().strip())
         try:
             self.age = int(age)
         except ValueError:
             self.age = 0
         self.nickname = nickname
-        self.role = role
-        self.address = address
-        self.city = city
+        self.role = intern_str(role)
+        self.address = intern_str(address)
+        self.city = intern_str(city)
 
     def __repr__(self):
         "String presentation of class"
@@ -87,6 +200,8 @@ class Person:
             raise ValueError(f"Attempting to update \"{self.first_name} {self.last_name}\" from "
                              f"\"{other.first_name} {other.last_name}\"")
         else:
+            STATS.count("person_updates")
+            Person.revision += 1
             self._update_attr(self, other, "phone")
             self._update_attr(self, other, "email", "replace")
             self._update_attr(self, other, "nickname")
@@ -94,14 +209,49 @@ class Person:
             self._update_attr(self, other, "address")
             self._update_attr(self, other, "city")
 
+    def merge(self, other):
+        "Fill in blank fields from another record believed to be the same person, even if the names differ"
+        Person.revision += 1
+        for field in ("phone", "email", "nickname", "role", "address", "city"):
+            if not getattr(self, field):
+                setattr(self, field, getattr(other, field))
+        self.age = self.age or other.age
+
 
 class Family:
     "Representation of a family group"
+    __slots__ = ("parents", "children", "_cache", "_cache_revision")
 
     def __init__(self, parents=[], children=[]):
         "Initalize blank family"
         self.parents = [p for p in parents if p.valid]
         self.children = [c for c in children if c.valid]
+        self._invalidate()
+
+    def __getstate__(self):
+        "Pickle the members only, derived values are recomputed"
+        return (self.parents, self.children)
+
+    def __setstate__(self, state):
+        "Restore from pickled members"
+        self.parents, self.children = state
+        self._invalidate()
+
+    def _invalidate(self):
+        "Drop cached derived values"
+        self._cache = {}
+        self._cache_revision = Person.revision
+
+    def _cached(self, name, compute):
+        """Return a derived value, computing it only if the family or any person changed since it was cached.
+        Changes made by assigning to the parents or children lists directly are not tracked."""
+        if self._cache_revision != Person.revision:
+            self._invalidate()
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = compute()
+            return value
 
     def __repr__(self):
         "(non constructable) representation"
@@ -118,6 +268,10 @@ class Family:
     @property
     def family_name(self):
         "A representation of the name of the family as a whole"
+        return self._cached("family_name", self._family_name)
+
+    def _family_name(self):
+        "Compute family_name"
         last_names = list(self.last_names)
         last_names.sort()
         for name_a in last_names:
@@ -138,36 +292,45 @@ class Family:
     @property
     def family_phone(self):
         "Returns common family phone number"
-        phones = collections.Counter([p.phone for p in self.parents + self.children])
-        return [phone for phone, count in phones.most_common(2) if count > 1 and phone]
+        def compute():
+            phones = collections.Counter([p.phone for p in self.parents + self.children])
+            return [phone for phone, count in phones.most_common(2) if count > 1 and phone]
+        return self._cached("family_phone", compute)
 
     @property
     def all_emails(self):
         "Return all emails in this family"
-        return [p.email for p in self.parents + self.children if p.email.strip()]
+        return self._cached("all_emails",
+                            lambda: [p.email for p in self.parents + self.children if p.email.strip()])
 
     @property
     def family_email(self):
         "Return common family email address if there is one"
-        emails = collections.Counter(self.all_emails)
-        return [email for email, count in emails.most_common(2) if count > 1 and email]
+        def compute():
+            emails = collections.Counter(self.all_emails)
+            return [email for email, count in emails.most_common(2) if count > 1 and email]
+        return self._cached("family_email", compute)
 
     @property
     def family_address(self):
         "Return common family address"
-        if self.children:
-            return (self.children[0].address, self.children[0].city)
-        return (self.parents[0].city,)
+        def compute():
+            if self.children:
+                return (self.children[0].address, self.children[0].city)
+            return (self.parents[0].city,)
+        return self._cached("family_address", compute)
 
     def sort(self, key=lambda p: (p.last_name, p.first_name)):
         "Trigger a sort on the parent and child lists. Default alphabetical by first name"
         self.parents.sort(key=key)
         self.children.sort(key=key)
+        self._invalidate()
 
     @staticmethod
     def _add_person(group, new_person):
         "Adds a new person to a list if not already present"
         if new_person.valid:
+            STATS.count("person_comparisons", len(group))
             for person in group:
                 if new_person == person:
                     person.update(new_person)
@@ -177,10 +340,12 @@ class Family:
     def add_or_update_parent(self, new_parent):
         "Adds a new parent to the family if not already present"
         self._add_person(self.parents, new_parent)
+        self._invalidate()
 
     def add_or_update_child(self, new_child):
         "Adds a new child to the family if not already present"
         self._add_person(self.children, new_child)
+        self._invalidate()
 
     def has_parent(self, first_name, last_name):
         "Check if this family has an adult with a given first and last name"
@@ -197,6 +362,508 @@ class Family:
         return False
 
 
+class FamilyBuilder:
+    "Assembles Family structures, joining households that share a parent"
+
+    def __init__(self):
+        "Initalize empty builder"
+        self._families = []
+        self._roots = []
+        self._parent_index = {}
+
+    @staticmethod
+    def name_key(person):
+        "Normalized (first, last) name used to index parents"
+        return (person.first_name.strip().lower(), person.last_name.strip().lower())
+
+    def _find(self, i):
+        "Find the root family index for family i, compressing the path"
+        root = i
+        while self._roots[root] != root:
+            root = self._roots[root]
+        while self._roots[i] != root:
+            self._roots[i], i = root, self._roots[i]
+        return root
+
+    def _union(self, a, b):
+        "Merge two families, keeping the one created first"
+        a, b = self._find(a), self._find(b)
+        if a == b:
+            return a
+        STATS.count("families_joined")
+        if b < a:
+            a, b = b, a
+        keep, drop = self._families[a], self._families[b]
+        for parent in drop.parents:
+            keep.add_or_update_parent(parent)
+        for child in drop.children:
+            keep.add_or_update_child(child)
+        self._roots[b] = a
+        self._families[b] = None
+        return a
+
+    def _new_family(self, parents=[], children=[]):
+        "Start a new family and return its index"
+        STATS.count("families_created")
+        self._families.append(Family(parents, children))
+        self._roots.append(len(self._roots))
+        return len(self._roots) - 1
+
+    def _lookup(self, person):
+        "Return the root index of the family that has this person as a parent, or None"
+        if not person.valid:
+            return None
+        STATS.count("parent_lookups")
+        i = self._parent_index.get(self.name_key(person))
+        return None if i is None else self._find(i)
+
+    def _add_parents(self, i, parents):
+        "Add parents to family i and index them"
+        family = self._families[i]
+        for parent in parents:
+            if parent.valid:
+                family.add_or_update_parent(parent)
+                self._parent_index.setdefault(self.name_key(parent), i)
+
+    def add_household(self, parents, children):
+        "Add children and their parents, joining any families that already know one of the parents"
+        root = None
+        for parent in parents:
+            i = self._lookup(parent)
+            if i is not None:
+                root = i if root is None else self._union(root, i)
+        if root is None:
+            root = self._new_family(children=children)
+        else:
+            for child in children:
+                self._families[root].add_or_update_child(child)
+        self._add_parents(root, parents)
+        return self._families[root]
+
+    def add_parent(self, parent):
+        "Add an adult to the family they are a parent in, or as a family of their own"
+        return self.add_household([parent], [])
+
+    @property
+    def families(self):
+        "List of assembled families in the order they were first seen"
+        return [f for f in self._families if f is not None]
+
+
+# Common nicknames, both directions are checked
+NICKNAMES = {
+    "alex": "alexander", "andy": "andrew", "ben": "benjamin", "beth": "elizabeth", "bill": "william",
+    "bob": "robert", "cathy": "catherine", "chris": "christopher", "dan": "daniel", "dave": "david",
+    "jen": "jennifer", "jenny": "jennifer", "jim": "james", "joe": "joseph", "kate": "katherine",
+    "katie": "katherine", "liz": "elizabeth", "matt": "matthew", "meg": "margaret", "mike": "michael",
+    "nick": "nicholas", "pat": "patricia", "rob": "robert", "sam": "samuel", "steve": "steven",
+    "sue": "susan", "tom": "thomas", "tony": "anthony", "will": "william",
+}
+SOUNDEX_CODES = {c: str(d) for d, letters in enumerate(("aehiouwy", "bfpv", "cgjkqsxz", "dt", "l", "mn", "r"))
+                 for c in letters}
+DEDUPE_THRESHOLD = 0.8
+DEDUPE_REPORT_THRESHOLD = 0.6
+# Blocks larger than this are shared values like a club office phone rather than evidence of a duplicate
+DEDUPE_MAX_BLOCK = 50
+DEDUPE_REPORT_KEYS = ["Score", "Merged", "Keep", "Duplicate", "Keep Family", "Duplicate Family", "Reasons"]
+# Ages of the same child can be a year apart between records taken at different times
+DEDUPE_MAX_AGE_GAP = 1
+# Reasons that keep a pair in the report without merging it, however well it scores
+DEDUPE_HOLD_REASONS = {"parent and child", "ages differ"}
+
+
+def soundex(name):
+    "Four character Soundex code of a name"
+    name = "".join(c for c in name.lower() if c.isalpha())
+    if not name:
+        return ""
+    code = name[0].upper()
+    last = SOUNDEX_CODES.get(name[0], "")
+    for c in name[1:]:
+        digit = SOUNDEX_CODES.get(c, "")
+        if digit not in ("0", last) and digit:
+            code += digit
+        if c not in "hw":
+            last = digit
+    return (code + "000")[:4]
+
+
+def normalize_phone(phone):
+    "Last ten digits of a phone number, or nothing if too short to be one"
+    digits = "".join(c for c in str(phone) if c.isdigit())[-10:]
+    return digits if len(digits) >= 7 else ""
+
+
+def _first_name_score(a, b):
+    "Similarity of two lower case first names, counting nicknames as the same"
+    import difflib
+    if a == b or NICKNAMES.get(a, a) == NICKNAMES.get(b, b):
+        return 1.0
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def person_match_score(a, b):
+    "Score from 0 to 1 of how likely two people records are the same person, with the reasons"
+    import difflib
+    first_a, last_a = FamilyBuilder.name_key(a)
+    first_b, last_b = FamilyBuilder.name_key(b)
+    straight = (_first_name_score(first_a, first_b) + difflib.SequenceMatcher(None, last_a, last_b).ratio()) / 2
+    swapped = (_first_name_score(first_a, last_b) + _first_name_score(last_a, first_b)) / 2
+    reasons = ["swapped names"] if swapped > straight else []
+    score = 0.7 * max(straight, swapped)
+    if a.email and a.email == b.email:
+        reasons.append("email")
+    if normalize_phone(a.phone) and normalize_phone(a.phone) == normalize_phone(b.phone):
+        reasons.append("phone")
+    if "email" in reasons or "phone" in reasons:
+        score += 0.3
+    return score, reasons
+
+
+def merge_holds(person_a, relation_a, person_b, relation_b):
+    "Reasons two possibly duplicate records must not be merged automatically"
+    holds = []
+    if relation_a != relation_b:
+        holds.append("parent and child")
+    if person_a.age and person_b.age and abs(person_a.age - person_b.age) > DEDUPE_MAX_AGE_GAP:
+        holds.append("ages differ")
+    return holds
+
+
+def blocking_keys(person):
+    "Keys grouping people who could be the same person"
+    first, last = FamilyBuilder.name_key(person)
+    keys = [("name",) + tuple(sorted((soundex(NICKNAMES.get(first, first)), soundex(last))))]
+    if person.email:
+        keys.append(("email", person.email))
+    phone = normalize_phone(person.phone)
+    if phone:
+        keys.append(("phone", phone))
+    return keys
+
+
+def find_duplicates(families, threshold=DEDUPE_REPORT_THRESHOLD):
+    """Find pairs of people in different families that may be the same person.
+    Only people sharing a blocking key are compared. Returns (score, reasons, person, family, person, family) tuples,
+    best first. Pairs of a parent and a child or with ages too far apart get one of DEDUPE_HOLD_REASONS."""
+    blocks = collections.defaultdict(list)
+    for fam in families:
+        for relation, people in (("parent", fam.parents), ("child", fam.children)):
+            for person in people:
+                for key in blocking_keys(person):
+                    blocks[key].append((person, relation, fam))
+    seen = set()
+    pairs = []
+    for block in blocks.values():
+        if len(block) > DEDUPE_MAX_BLOCK:
+            continue
+        for i, (person_a, relation_a, fam_a) in enumerate(block):
+            for person_b, relation_b, fam_b in block[i + 1:]:
+                pair = (id(person_a), id(person_b))
+                if fam_a is fam_b or pair in seen:
+                    continue
+                seen.add(pair)
+                score, reasons = person_match_score(person_a, person_b)
+                if score >= threshold:
+                    reasons += merge_holds(person_a, relation_a, person_b, relation_b)
+                    pairs.append((score, reasons, person_a, fam_a, person_b, fam_b))
+    pairs.sort(key=lambda pair: -pair[0])
+    return pairs
+
+
+@STATS.timed("dedupe")
+def dedupe_families(families, report_file=None, threshold=DEDUPE_THRESHOLD):
+    """Merge people found by find_duplicates scoring at least threshold, joining their families.
+    Pairs held back by DEDUPE_HOLD_REASONS are only reported.
+    A CSV review report of every candidate pair is written to report_file if given."""
+    pairs = find_duplicates(families)
+    index = {id(fam): i for i, fam in enumerate(families)}
+    roots = list(range(len(families)))
+    replaced = {}
+
+    def find(i):
+        "Root family index"
+        while roots[i] != i:
+            roots[i] = roots[roots[i]]
+            i = roots[i]
+        return i
+
+    def resolve(person):
+        "The record a person was merged into"
+        while id(person) in replaced:
+            person = replaced[id(person)]
+        return person
+
+    merged = []
+    for score, reasons, person_a, fam_a, person_b, fam_b in pairs:
+        keep, duplicate = resolve(person_a), resolve(person_b)
+        if score < threshold or keep is duplicate or DEDUPE_HOLD_REASONS.intersection(reasons):
+            merged.append(False)
+            continue
+        keep.merge(duplicate)
+        replaced[id(duplicate)] = keep
+        a, b = find(index[id(fam_a)]), find(index[id(fam_b)])
+        roots[max(a, b)] = min(a, b)
+        merged.append(True)
+    if report_file:
+        with open(report_file, "wt") as fh:
+            writer = csv.writer(fh, delimiter=",")
+            writer.writerow(DEDUPE_REPORT_KEYS)
+            for (score, reasons, person_a, fam_a, person_b, fam_b), was_merged in zip(pairs, merged):
+                writer.writerow([f"{score:.2f}", "yes" if was_merged else "no",
+                                 f"{person_a.first_name} {person_a.last_name}",
+                                 f"{person_b.first_name} {person_b.last_name}",
+                                 fam_a.family_name, fam_b.family_name, " ".join(reasons)])
+    if not any(merged):
+        return families
+    groups = collections.defaultdict(list)
+    for i, fam in enumerate(families):
+        groups[find(i)].append(fam)
+    deduped = []
+    for root in sorted(groups):
+        parents = [resolve(p) for fam in groups[root] for p in fam.parents]
+        parent_ids = {id(p) for p in parents}
+        # Someone listed as a parent in one family and a child in another stays a parent
+        children = [resolve(c) for fam in groups[root] for c in fam.children if id(resolve(c)) not in parent_ids]
+        new_fam = Family(_fold_people(parents, "parent"), _fold_people(children, "child"))
+        new_fam.sort()
+        deduped.append(new_fam)
+    return deduped
+
+
+def _fold_people(people, relation):
+    """Combine the records of people joined into one family that have the same name and compatible ages,
+    such as a child listed in both halves of a household that was split by a parent's nickname"""
+    folded = []
+    by_name = collections.defaultdict(list)
+    for person in people:
+        same = by_name[FamilyBuilder.name_key(person)]
+        match = next((p for p in same if p is person or not merge_holds(p, relation, person, relation)), None)
+        if match is None:
+            same.append(person)
+            folded.append(person)
+        elif match is not person:
+            match.merge(person)
+    return folded
+
+
+ODS_TABLE_NS = "urn:oasis:names:tc:opendocument:xmlns:table:1.0"
+ODS_TEXT_NS = "urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+ODS_OFFICE_NS = "urn:oasis:names:tc:opendocument:xmlns:office:1.0"
+ODS_TABLE = f"{{{ODS_TABLE_NS}}}table"
+ODS_ROW = f"{{{ODS_TABLE_NS}}}table-row"
+ODS_CELL = f"{{{ODS_TABLE_NS}}}table-cell"
+ODS_COVERED_CELL = f"{{{ODS_TABLE_NS}}}covered-table-cell"
+ODS_P = f"{{{ODS_TEXT_NS}}}p"
+ODS_S = f"{{{ODS_TEXT_NS}}}s"
+ODS_TAB = f"{{{ODS_TEXT_NS}}}tab"
+ODS_LINE_BREAK = f"{{{ODS_TEXT_NS}}}line-break"
+ODS_NUMERIC_TYPES = ("float", "percentage", "currency")
+
+# Bump whenever parsing or the Family / Person structures change to invalidate cached rosters
+PARSER_VERSION = 4
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "rostermangler")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Columns of the Members sheet read by get_members_as_families
+MEMBER_COLUMNS = (
+    "Member: Last Name", "Member: First Name", "Member: Email", "Member: Primary Phone", "Member: Age",
+    "Family: Address", "Family: City", "Family: Family Email",
+    "Member: Parent 1 First Name", "Member: Parent 1 Last Name", "Member: Parent 1 Cell Phone",
+    "Member: Parent 2 First Name", "Member: Parent 2 Last Name", "Member: Parent 2 Email",
+    "Member: Parent 2 Home Phone",
+)
+
+
+def _ods_text(element):
+    "Collect the text of an ODS paragraph, expanding space, tab and line break elements"
+    parts = [element.text or ""]
+    for child in element:
+        if child.tag == ODS_S:
+            parts.append(" " * int(child.get(f"{{{ODS_TEXT_NS}}}c", "1")))
+        elif child.tag == ODS_TAB:
+            parts.append("\t")
+        elif child.tag == ODS_LINE_BREAK:
+            parts.append("\n")
+        else:
+            parts.append(_ods_text(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def _ods_cell_value(cell):
+    "Convert an ODS cell element into a python value"
+    value_type = cell.get(f"{{{ODS_OFFICE_NS}}}value-type")
+    if value_type in ODS_NUMERIC_TYPES:
+        value = float(cell.get(f"{{{ODS_OFFICE_NS}}}value"))
+        return int(value) if value.is_integer() else value
+    return "\n".join(_ods_text(p) for p in cell.iter(ODS_P))
+
+
+def _ods_row_cells(row, wanted=None):
+    "Expand an ODS row element into a list of values, trimming trailing blanks"
+    cells = []
+    pending = 0
+    limit = max(wanted) + 1 if wanted else None
+    for cell in row:
+        if cell.tag not in (ODS_CELL, ODS_COVERED_CELL):
+            continue
+        repeat = int(cell.get(f"{{{ODS_TABLE_NS}}}number-columns-repeated", "1"))
+        column = len(cells) + pending
+        if limit is not None and column >= limit:
+            break
+        if wanted is not None and not any(c in wanted for c in range(column, column + repeat)):
+            pending += repeat
+            continue
+        value = _ods_cell_value(cell)
+        if value == "":
+            pending += repeat
+            continue
+        # Blank runs are only expanded once a value follows them
+        cells.extend([""] * pending)
+        pending = 0
+        if limit is not None:
+            repeat = min(repeat, limit - len(cells))
+        cells.extend([value] * repeat)
+    return cells
+
+
+# Format name: (file extensions, function streaming (sheet name, row) pairs from a file)
+INPUT_READERS = {}
+
+
+def register_reader(name, extensions):
+    """Decorator adding a row reader for an input format.
+    Readers take a file name and a dict of the wanted sheet names to the column names to read from them, or None
+    for all columns, and produce (sheet name, row) pairs. Readers should import any heavy library they need
+    themselves, so that it is only loaded for that format."""
+    def decorator(func):
+        INPUT_READERS[name] = (tuple(extensions), func)
+        return func
+    return decorator
+
+
+def sniff_format(file_name):
+    "Guess the input format of a file from its contents"
+    with open(file_name, "rb") as fh:
+        magic = fh.read(4)
+    if magic == b"PK\x03\x04":
+        import zipfile
+        with zipfile.ZipFile(file_name) as book:
+            names = set(book.namelist())
+        if "content.xml" in names:
+            return "ods"
+        if "xl/workbook.xml" in names:
+            return "xlsx"
+    return "csv"
+
+
+def input_format(file_name):
+    "Input format of a file, by extension or failing that by its contents"
+    ext = os.path.splitext(file_name)[1].lower()
+    for name, (extensions, _) in INPUT_READERS.items():
+        if ext in extensions:
+            return name
+    return sniff_format(file_name)
+
+
+def iter_rows(file_name, sheets):
+    "Stream (sheet name, row) pairs of the wanted sheets from a file in any registered input format"
+    return INPUT_READERS[input_format(file_name)][1](file_name, sheets)
+
+
+def read_csv_rows(csv_file):
+    "Stream the rows of a CSV file, given as an open text file or a file name"
+    if isinstance(csv_file, str):
+        with open(csv_file, "rt", newline="") as fh:
+            yield from csv.reader(fh, delimiter=",")
+    else:
+        yield from csv.reader(csv_file, delimiter=",")
+
+
+@register_reader("csv", (".csv",))
+def iter_csv_rows(csv_file, sheets):
+    "Stream the rows of a CSV file as the first wanted sheet, since CSV files only have one"
+    sheet_name = next(iter(sheets))
+    for row in read_csv_rows(csv_file):
+        while row and row[-1] == "":
+            row.pop()
+        yield sheet_name, row
+
+
+@register_reader("xlsx", (".xlsx", ".xlsm"))
+def iter_xlsx_rows(xlsx_file, sheets):
+    "Stream (sheet name, row) pairs from an Excel workbook, in workbook sheet order"
+    try:
+        import openpyxl
+    except ImportError as err:
+        raise ImportError("Reading Excel exports needs openpyxl installed") from err
+    book = openpyxl.load_workbook(xlsx_file, read_only=True, data_only=True)
+    try:
+        for sheet_name in book.sheetnames:
+            if sheet_name not in sheets:
+                continue
+            for cells in book[sheet_name].iter_rows(values_only=True):
+                row = ["" if value is None else value for value in cells]
+                while row and row[-1] == "":
+                    row.pop()
+                yield sheet_name, row
+    finally:
+        book.close()
+
+
+@register_reader("ods", (".ods",))
+def iter_ods_rows(ods_file, sheets):
+    """Stream (sheet name, row) pairs from an ODS workbook.
+    `sheets` maps the wanted sheet names to the column names to read from them, or None for all columns.
+    Other sheets are skipped and rows are produced in document order."""
+    import zipfile
+    import xml.etree.ElementTree as ElementTree
+    with zipfile.ZipFile(ods_file) as book, book.open("content.xml") as content:
+        sheet_name = None
+        wanted = None
+        header = None
+        pending = 0
+        for event, element in ElementTree.iterparse(content, events=("start", "end")):
+            if event == "start":
+                if element.tag == ODS_TABLE:
+                    sheet_name = element.get(f"{{{ODS_TABLE_NS}}}name")
+                    header = None
+                    pending = 0
+                continue
+            if element.tag == ODS_ROW:
+                if sheet_name in sheets:
+                    row = _ods_row_cells(element, wanted)
+                    if header is None:
+                        header = row
+                        columns = sheets[sheet_name]
+                        wanted = None if columns is None else \
+                            {i for i, k in enumerate(header) if isinstance(k, str) and k.strip() in columns}
+                        yield sheet_name, row
+                    elif not row:
+                        pending += int(element.get(f"{{{ODS_TABLE_NS}}}number-rows-repeated", "1"))
+                    else:
+                        # Blank rows are only produced once a row with data follows them
+                        for _ in range(pending):
+                            yield sheet_name, []
+                        pending = 0
+                        for _ in range(int(element.get(f"{{{ODS_TABLE_NS}}}number-rows-repeated", "1"))):
+                            yield sheet_name, list(row)
+                element.clear()
+            elif element.tag == ODS_TABLE:
+                sheet_name = None
+                wanted = None
+                element.clear()
+
+
+def read_sheets(file_name, sheets):
+    "Read the wanted sheets of a workbook into a dict of row lists"
+    book = {}
+    for sheet_name, row in iter_rows(file_name, sheets):
+        book.setdefault(sheet_name, []).append(row)
+    return book
+
+
 def get_cell(row, keys, key):
     "Use an index dictionary to retrieve the right column from a row"
     ind = keys[key]
@@ -211,10 +878,13 @@ def get_adult_volunteers_as_people(sheet, keys):
             for row in sheet if len(row) > 5]
 
 
-def get_members_as_families(sheet, keys):
+@STATS.timed("family_build")
+def get_members_as_families(sheet, keys, builder=None):
     "Return a list of Family data structures from Members sheet"
-    families = []
+    if builder is None:
+        builder = FamilyBuilder()
     for row in sheet:
+        STATS.count("member_rows_read")
         if len(row) < 3:
             continue
         member = Person(last_name=get_cell(row, keys, "Member: Last Name"),
@@ -234,16 +904,8 @@ def get_members_as_families(sheet, keys):
                          get_cell(row, keys, "Member: Parent 2 Last Name"),
                          email=get_cell(row, keys, "Member: Parent 2 Email"),
                          phone=get_cell(row, keys, "Member: Parent 2 Home Phone"))
-        for family in families:
-            if family.has_parent(parent1.first_name, parent1.last_name) or \
-               family.has_parent(parent2.first_name, parent2.last_name):
-                family.add_or_update_child(member)
-                family.add_or_update_parent(parent1)
-                family.add_or_update_parent(parent2)
-                break
-        else:
-            new_fam = Family([parent1, parent2], [member])
-            families.append(new_fam)
+        builder.add_household([parent1, parent2], [member])
+    families = builder.families
     for fam in families:
         fam.sort()
     return families
@@ -256,35 +918,307 @@ def keys_row_to_keys_dict(keys):
 
 def get_families_from_ucnar_ods(ods_file):
     "Convert an UCNAR export ODS file into a list of Family data structures"
-    # Crack open the workbook file
-    book = pyexcel_ods.get_data(ods_file)
-    members_sheet = book['Members']
-    member_keys = keys_row_to_keys_dict(members_sheet.pop(0))
-    try:
-        adults_sheet = book['Adult Volunteers']
-    except KeyError:
-        sys.stderr.write("No adult volunteers sheet")
-        adults = []
-    else:
-        adult_keys = keys_row_to_keys_dict(adults_sheet.pop(0))
-        # Parse the adult voluteers sheet
-        adults = get_adult_volunteers_as_people(adults_sheet, adult_keys)
+    # Stream the workbook, setting aside adult volunteer rows while the members are read
+    rows = STATS.timed_iter("parse", iter_rows(ods_file, {"Members": MEMBER_COLUMNS, "Adult Volunteers": None}))
+    adults_sheet = []
+    member_keys = None
+    for sheet_name, row in rows:
+        if sheet_name == "Members":
+            member_keys = keys_row_to_keys_dict(row)
+            break
+        adults_sheet.append(row)
+    if member_keys is None:
+        raise KeyError("Members")
+
+    def members_sheet():
+        "Member rows of the stream"
+        for sheet_name, row in rows:
+            if sheet_name == "Members":
+                yield row
+            else:
+                adults_sheet.append(row)
+
     # Parse the members sheet
-    families = get_members_as_families(members_sheet, member_keys)
-    # Unify the results
-    for adult in adults:
-        for family in families:
-            if family.has_parent(adult.first_name, adult.last_name):
-                family.add_or_update_parent(adult)
-                break
+    builder = FamilyBuilder()
+    get_members_as_families(members_sheet(), member_keys, builder)
+    with STATS.stage("adult_unification"):
+        if not adults_sheet:
+            sys.stderr.write("No adult volunteers sheet")
+            adults = []
         else:
-            families.append(Family(parents=[adult]))
+            adult_keys = keys_row_to_keys_dict(adults_sheet.pop(0))
+            # Parse the adult voluteers sheet
+            adults = get_adult_volunteers_as_people(adults_sheet, adult_keys)
+            STATS.count("adult_rows_read", len(adults_sheet))
+        # Unify the results
+        for adult in adults:
+            builder.add_parent(adult)
+    return builder.families
+
+
+def file_digest(file_name):
+    "SHA-256 hex digest of a file's contents"
+    digest = hashlib.sha256()
+    with open(file_name, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def evict_cache(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    "Remove least recently used cache entries until the cache fits in max_bytes"
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".pickle"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def person_from_fields(fields):
+    "Rebuild a person from the tuple of fields made by person_signature"
+    person = Person.__new__(Person)
+    for field, value in zip(Person.__slots__, fields):
+        setattr(person, field, value)
+    return person
+
+
+def families_to_data(families):
+    """Plain tuples of the people in a list of families for pickling.
+    Unlike pickled Family objects these load whether this file was run as a script or imported as a module."""
+    return [([person_signature(p) for p in fam.parents], [person_signature(c) for c in fam.children])
+            for fam in families]
+
+
+def families_from_data(data):
+    "Rebuild a list of families from families_to_data"
+    return [Family([person_from_fields(p) for p in parents], [person_from_fields(c) for c in children])
+            for parents, children in data]
+
+
+@STATS.timed("cache")
+def load_families(ods_file, cache_dir=None):
+    """Get the list of families in a UCNAR export, reusing a previous parse when cached.
+    Cache entries are keyed on the file contents and PARSER_VERSION. Pass cache_dir=None to always parse.
+    Families are read from a roster store instead if given one."""
+    if is_store(ods_file):
+        return store_families(ods_file)
+    if cache_dir is None:
+        return get_families_from_ucnar_ods(ods_file)
+    cache_file = os.path.join(cache_dir, f"{file_digest(ods_file)}-{PARSER_VERSION}.pickle")
+    try:
+        with open(cache_file, "rb") as fh:
+            families = families_from_data(pickle.load(fh))
+    except Exception:
+        # Missing, corrupt or incompatible entries are just parsed again
+        pass
+    else:
+        # A read only cache is still used, it just can't record which entries were used recently
+        with contextlib.suppress(OSError):
+            os.utime(cache_file)
+        return families
+    families = get_families_from_ucnar_ods(ods_file)
+    try:
+        # Entries hold members' contact details, most of them minors, so only the user can read them
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as fh:
+            pickle.dump(families_to_data(families), fh, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        evict_cache(cache_dir)
+    except OSError as err:
+        sys.stderr.write(f"Could not write roster cache: {err}{os.linesep}")
+    return families
+
+
+STORE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+STORE_FIELDS = ("first_name", "last_name", "phone", "email", "age", "nickname", "role", "address", "city")
+# Fields that can be searched with store_find, all indexed
+STORE_SEARCH_FIELDS = ("first_name", "last_name", "email", "phone", "city", "role", "age")
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS families (
+    id INTEGER PRIMARY KEY,
+    club TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS people (
+    id INTEGER PRIMARY KEY,
+    family_id INTEGER NOT NULL REFERENCES families(id),
+    relation TEXT NOT NULL CHECK (relation IN ('parent', 'child')),
+    first_key TEXT NOT NULL,
+    last_key TEXT NOT NULL,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    phone TEXT,
+    email TEXT,
+    age INTEGER,
+    nickname TEXT,
+    role TEXT,
+    address TEXT,
+    city TEXT,
+    club TEXT NOT NULL DEFAULT '',
+    import_id INTEGER NOT NULL,
+    UNIQUE (family_id, last_key, first_key)
+);
+CREATE INDEX IF NOT EXISTS people_key ON people (club, relation, last_key, first_key);
+CREATE INDEX IF NOT EXISTS people_first_name ON people (first_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS people_last_name ON people (last_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS people_email ON people (email);
+CREATE INDEX IF NOT EXISTS people_phone ON people (phone);
+CREATE INDEX IF NOT EXISTS people_city ON people (city COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS people_role ON people (role COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS people_age ON people (relation, age);
+CREATE INDEX IF NOT EXISTS people_club ON people (club, import_id);
+"""
+
+
+def is_store(file_name):
+    "Check if a file name is a roster store rather than an export"
+    return os.path.splitext(file_name)[1].lower() in STORE_EXTENSIONS
+
+
+def open_store(db_file, create=False):
+    "Open a SQLite roster store. Only with create is a missing store made, rather than raising FileNotFoundError"
+    import sqlite3
+    import pathlib
+    if not create:
+        try:
+            return sqlite3.connect(f"{pathlib.Path(db_file).absolute().as_uri()}?mode=rw", uri=True)
+        except sqlite3.OperationalError as err:
+            raise FileNotFoundError(f"Can't open roster store {db_file}: {err}") from None
+    db = sqlite3.connect(db_file)
+    db.executescript(STORE_SCHEMA)
+    return db
+
+
+@STATS.timed("store_import")
+def store_import(db_file, families, club="", prune=True):
+    """Upsert families into a roster store.
+    A family is matched to the stored family of the same club that has one of its parents, or for a family without
+    parents one of its children, by normalized name. People are matched by name within that family only, so people
+    with the same name in other families or clubs are kept apart. With prune, people of the same club missing from
+    these families are removed, as are families left empty. The store is created if it doesn't exist."""
+    db = open_store(db_file, create=True)
+    with db:
+        import_id = db.execute("SELECT COALESCE(MAX(import_id), 0) + 1 FROM people").fetchone()[0]
+        for fam in families:
+            people = [("parent", p) for p in fam.parents] + [("child", c) for c in fam.children]
+            family_id = None
+            for relation, person in people:
+                if relation == "child" and fam.parents:
+                    break
+                found = db.execute("SELECT MIN(family_id) FROM people WHERE club = ? AND relation = ? AND "
+                                   "last_key = ? AND first_key = ?",
+                                   (club, relation) + FamilyBuilder.name_key(person)[::-1]).fetchone()
+                if found[0] is not None:
+                    family_id = found[0]
+                    break
+            if family_id is None:
+                family_id = db.execute("INSERT INTO families (club) VALUES (?)", (club,)).lastrowid
+            for relation, person in people:
+                first_key, last_key = FamilyBuilder.name_key(person)
+                db.execute(f"INSERT INTO people (family_id, relation, first_key, last_key, club, import_id, "
+                           f"{', '.join(STORE_FIELDS)}) "
+                           f"VALUES (?, ?, ?, ?, ?, ?, {', '.join('?' * len(STORE_FIELDS))}) "
+                           "ON CONFLICT (family_id, last_key, first_key) DO UPDATE SET "
+                           "relation = excluded.relation, import_id = excluded.import_id, "
+                           f"{', '.join(f'{f} = excluded.{f}' for f in STORE_FIELDS)}",
+                           (family_id, relation, first_key, last_key, club, import_id) +
+                           tuple(getattr(person, f) for f in STORE_FIELDS))
+        if prune:
+            db.execute("DELETE FROM people WHERE club = ? AND import_id != ?", (club, import_id))
+        db.execute("DELETE FROM families WHERE id NOT IN (SELECT family_id FROM people)")
+    db.close()
+    return import_id
+
+
+def _store_rows_to_families(rows):
+    "Build families from store rows of family id, relation and STORE_FIELDS, ordered by family id"
+    families = []
+    family_id = None
+    for row in rows:
+        if row[0] != family_id:
+            family_id = row[0]
+            families.append(Family())
+        person = Person(**{f: v if v is not None or f not in ("first_name", "last_name", "phone", "email")
+                           else "" for f, v in zip(STORE_FIELDS, row[2:])})
+        (families[-1].parents if row[1] == "parent" else families[-1].children).append(person)
+    for fam in families:
+        fam.sort()
     return families
 
 
+@STATS.timed("store_query")
+def store_families(db_file, min_age=None, club=None):
+    """Load families from a roster store.
+    With min_age only children at least that old, and families with any such child, are loaded. The filtering
+    is done by the age index rather than in python."""
+    conditions = []
+    params = []
+    if club is not None:
+        conditions.append("club = ?")
+        params.append(club)
+    if min_age:
+        conditions.append("((relation = 'child' AND age >= ?) OR (relation = 'parent' AND family_id IN "
+                          "(SELECT family_id FROM people WHERE relation = 'child' AND age >= ?)))")
+        params += [min_age, min_age]
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    db = open_store(db_file)
+    try:
+        rows = db.execute(f"SELECT family_id, relation, {', '.join(STORE_FIELDS)} FROM people {where} "
+                          "ORDER BY family_id, id", params)
+        return _store_rows_to_families(rows)
+    finally:
+        db.close()
+
+
+def store_find_condition(field, value):
+    "SQL condition and its parameter for a store_find search, raising ValueError for a bad field or value"
+    if field not in STORE_SEARCH_FIELDS:
+        raise ValueError(f"Can't search by {field!r}, use one of {', '.join(STORE_SEARCH_FIELDS)}")
+    if field == "age":
+        try:
+            return "relation = 'child' AND age >= ?", int(value)
+        except ValueError:
+            raise ValueError(f"Age must be a whole number, not {value!r}") from None
+    if field == "role":
+        return "role LIKE ?", f"%{value}%"
+    if field in ("email", "phone"):
+        return f"{field} = ?", value.lower().strip() if field == "email" else value.strip()
+    return f"{field} = ? COLLATE NOCASE", value
+
+
+def store_find(db_file, field, value):
+    """People in a roster store with a field matching a value, as (family name, person) pairs.
+    Text fields match case insensitively, role matches any part of the role and age matches that age or older."""
+    condition, param = store_find_condition(field, value)
+    db = open_store(db_file)
+    try:
+        matches = db.execute(f"SELECT family_id FROM people WHERE {condition}", (param,)).fetchall()
+        family_ids = sorted({row[0] for row in matches})
+        rows = db.execute(f"SELECT family_id, relation, {', '.join(STORE_FIELDS)} FROM people "
+                          f"WHERE family_id IN ({', '.join('?' * len(family_ids))}) ORDER BY family_id, id",
+                          family_ids).fetchall()
+        found = db.execute(f"SELECT family_id, first_key, last_key FROM people WHERE {condition}",
+                           (param,)).fetchall()
+    finally:
+        db.close()
+    found = set(found)
+    # Families come back in family id order, one for each matched id
+    return [(fam.family_name, person) for family_id, fam in zip(family_ids, _store_rows_to_families(rows))
+            for person in fam.parents + fam.children if (family_id,) + FamilyBuilder.name_key(person) in found]
+
+
 def get_members_and_volunteers_from_ucnar_ods(ods_file):
     "Get members and adult volunteers list from ODS excport."
-    sheet = pyexcel_ods.get_data(ods_file)
+    sheet = read_sheets(ods_file, {"Members": None, "Adult Volunteers": None})
     members = sheet['Members']
     member_keys = members.pop(0)
     members_email_dict = {row[1]: row for row in members if row}
@@ -294,45 +1228,34 @@ def get_members_and_volunteers_from_ucnar_ods(ods_file):
     return member_keys, members_email_dict, adult_keys, adults_email_dict
 
 
-def get_members_and_adults_from_csv(csv_file):
-    "Get members and adults from Del Arroyo CSV file format"
-    sheet = list(csv.reader(csv_file, delimiter=","))
-    sheet_keys = sheet.pop(0)
-    email_col = sheet_keys.index("Family: Family Email")
-    email_dict = {row[email_col].lower(): row for row in sheet if row}
-    return sheet_keys, email_dict
-
+def normalize_email(email):
+    "Email address in the form used as a key across exports"
+    return email.lower().strip()
 
-def get_wordpress_data(wordpress_csv, filter_activated=False):
-    "Load a list of families from Wordpress user export"
-    sheet = list(csv.reader(wordpress_csv, delimiter=","))
-    sheet_keys = sheet.pop(0)
-    email_col = sheet_keys.index('Email')
-    act_col = sheet_keys.index('Activated?')
-    email_dict = {row[email_col].lower(): row for row in sheet if (row and
-                                                                   (filter_activated is False or
-                                                                    row[act_col] == filter_activated))}
-    return sheet_keys, email_dict
 
+def iter_csv_columns(csv_file, columns):
+    """Stream (projected values, row) pairs from a CSV file with a heading row.
+    `columns` are heading names or column numbers, missing cells read as blank and blank rows are skipped."""
+    rows = read_csv_rows(csv_file)
+    keys = next(rows, [])
+    indexes = [c if isinstance(c, int) else keys.index(c) for c in columns]
+    for row in rows:
+        if row:
+            yield tuple(row[i] if i < len(row) else "" for i in indexes), row
 
-def get_mailchip_data(mailchimp_csv):
-    "Load CSV file from mailchimp export"
-    sheet = list(csv.reader(mailchimp_csv, delimiter=","))
-    sheet_keys = sheet.pop(0)
-    email_dict = {row[0]: row for row in sheet}
-    return sheet_keys, email_dict
 
-
-def extra_in_mailchimp(mailchimp_email_dict, families):
-    "Find the email rows that are extra in mailchimp"
-    known_emails = set()
-    for fam in families:
-        known_emails.update(fam.all_emails)
-    unknown = []
-    for email, row in mailchimp_email_dict.items():
-        if email.lower().strip() not in known_emails:
-            unknown.append(row)
-    return unknown
+def stream_mailchimp_removes(mailchimp_export, known_emails, remove_writer):
+    """Stream a Mailchimp export, writing the rows for addresses not in known_emails to remove_writer.
+    Only the set of subscribed addresses is kept, which is returned."""
+    mailchimp_emails = set()
+    for (email,), row in iter_csv_columns(mailchimp_export, [0]):
+        email = normalize_email(email)
+        if email in mailchimp_emails:
+            continue
+        mailchimp_emails.add(email)
+        if email not in known_emails:
+            remove_writer.writerow(row)
+    return mailchimp_emails
 
 
 def missing_from_mailchimp(mailchimp_email_dict, families, strict):
@@ -341,10 +1264,10 @@ def missing_from_mailchimp(mailchimp_email_dict, families, strict):
     for fam in families:
         for email in fam.all_emails:
             if strict:
-                if email not in mailchimp_email_dict.keys():
+                if email not in mailchimp_email_dict:
                     missing_families.add(fam)
             else:
-                if email in mailchimp_email_dict.keys():
+                if email in mailchimp_email_dict:
                     break
         else:
             if not strict:
@@ -352,115 +1275,1120 @@ def missing_from_mailchimp(mailchimp_email_dict, families, strict):
     return missing_families
 
 
-def roster_merge(roster_input, mailchimp_export, strict=False):
+def roster_merge(roster_input, mailchimp_export, strict=False, cache_dir=None, output_dir=".", dedupe_report=None):
     "Program entry"
     # Parse inputs
-    families = get_families_from_ucnar_ods(roster_input)
-    mailchimp_sheet_keys, mailchimp_email_dict = get_mailchip_data(mailchimp_export)
-    # Make possible remove output
-    possible_rm = extra_in_mailchimp(mailchimp_email_dict, families)
-    with open("possible_remove.csv", "wt") as possible_rm_file:
+    families = load_families(roster_input, cache_dir)
+    if dedupe_report:
+        families = dedupe_families(families, dedupe_report)
+    return merge_families(families, mailchimp_export, strict, output_dir)
+
+
+@STATS.timed("mailchimp_reconcile")
+def merge_families(families, mailchimp_export, strict=False, output_dir="."):
+    """Write the possible add and remove sheets for a Mailchimp export against a list of families.
+    Returns the number of possible removes and the families to possibly add"""
+    known_emails = {email for fam in families for email in fam.all_emails}
+    # Make possible remove output while reading the export
+    with open(os.path.join(output_dir, "possible_remove.csv"), "wt") as possible_rm_file:
         writer = csv.writer(possible_rm_file, delimiter=",")
-        for row in possible_rm:
-            writer.writerow(row)
+        mailchimp_emails = stream_mailchimp_removes(mailchimp_export, known_emails, writer)
     # Make possible add output
-    possible_add_families = missing_from_mailchimp(mailchimp_email_dict, families, strict)
-    with open("possible_add.csv", "wt") as possible_add_file:
+    possible_add_families = missing_from_mailchimp(mailchimp_emails, families, strict)
+    with open(os.path.join(output_dir, "possible_add.csv"), "wt") as possible_add_file:
         writer = csv.writer(possible_add_file, delimiter=",")
         for fam in possible_add_families:
             writer.writerow([fam.family_name] + list(set(fam.all_emails)))
+    return len(mailchimp_emails - known_emails), possible_add_families
 
 
-def filter_min_age(families, min_age):
-    "Removes entries where the member minimum age is below the threshold"
+FILTER_TOKEN = re.compile(r"""\s*(?:(?P<number>\d+(?:\.\d+)?)|(?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')"""
+                          r"|(?P<op>==|!=|>=|<=|=|>|<|~)|(?P<paren>[()])|(?P<word>\w+))")
+FILTER_OPS = {
+    "==": operator.eq, "=": operator.eq, "!=": operator.ne, ">=": operator.ge, "<=": operator.le,
+    ">": operator.gt, "<": operator.lt, "~": lambda value, wanted: wanted in value,
+}
+# Fields a filter can test, relation is "parent" or "child"
+FILTER_FIELDS = Person.__slots__ + ("relation",)
+# Fields compared as numbers, everything else is compared as text
+FILTER_NUMERIC_FIELDS = ("age",)
+
+
+def _filter_tokens(text):
+    "Split a filter expression into (kind, value) tokens"
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = FILTER_TOKEN.match(text, pos)
+        if not match or match.end() == pos:
+            raise ValueError(f"Can't understand filter at {text[pos:]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "word" and value.lower() in ("and", "or", "not"):
+            kind, value = "keyword", value.lower()
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+def compile_filter(text):
+    """Compile a filter expression such as `age>=9 and city=="Pasadena" and role~"Leader"` into a predicate
+    taking a person and their relation, "parent" or "child". Text comparisons ignore case and ~ tests if the field
+    contains the value. Conditions combine with and, or, not and parentheses."""
+    tokens = _filter_tokens(text)
+    pos = 0
+
+    def peek():
+        "Next token"
+        return tokens[pos] if pos < len(tokens) else (None, None)
+
+    def take(kind=None, value=None):
+        "Consume the next token, checking it is what is expected"
+        nonlocal pos
+        token = peek()
+        if token[0] is None:
+            raise ValueError(f"Unexpected end of filter {text!r}")
+        if (kind and token[0] != kind) or (value and token[1] != value):
+            raise ValueError(f"Expected {value or kind} instead of {token[1]!r} in filter {text!r}")
+        pos += 1
+        return token[1]
+
+    def comparison():
+        "field op value"
+        field = take("word")
+        if field not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter field {field!r}, use one of {', '.join(FILTER_FIELDS)}")
+        op = take("op")
+        compare = FILTER_OPS[op]
+        kind, literal = peek()
+        take()
+        if kind == "number":
+            if field not in FILTER_NUMERIC_FIELDS:
+                raise ValueError(f"Can't compare {field} with a number in filter {text!r}, only "
+                                 f"{', '.join(FILTER_NUMERIC_FIELDS)} can be")
+            if op == "~":
+                raise ValueError(f"Can't use ~ with a number in filter {text!r}")
+            wanted = float(literal)
+            return lambda person, relation: compare(getattr(person, field) or 0, wanted)
+        if kind == "string":
+            wanted = re.sub(r"""\\(["'\\])""", r"\1", literal[1:-1]).lower()
+        elif kind == "word":
+            wanted = literal.lower()
+        else:
+            raise ValueError(f"Expected a value after {field} in filter {text!r}")
+        if field == "relation":
+            return lambda person, relation: compare(relation, wanted)
+        return lambda person, relation: compare(str(getattr(person, field) or "").lower(), wanted)
+
+    def term():
+        "not term, (expression) or comparison"
+        if peek() == ("keyword", "not"):
+            take()
+            inner = term()
+            return lambda person, relation: not inner(person, relation)
+        if peek() == ("paren", "("):
+            take()
+            inner = expression()
+            take("paren", ")")
+            return inner
+        return comparison()
+
+    def conjunction():
+        "term and term ..."
+        terms = [term()]
+        while peek() == ("keyword", "and"):
+            take()
+            terms.append(term())
+        return terms[0] if len(terms) == 1 else lambda person, relation: all(t(person, relation) for t in terms)
+
+    def expression():
+        "conjunction or conjunction ..."
+        terms = [conjunction()]
+        while peek() == ("keyword", "or"):
+            take()
+            terms.append(conjunction())
+        return terms[0] if len(terms) == 1 else lambda person, relation: any(t(person, relation) for t in terms)
+
+    predicate = expression()
+    if pos != len(tokens):
+        raise ValueError(f"Unexpected {tokens[pos][1]!r} in filter {text!r}")
+    return predicate
+
+
+def filter_families(families, predicate):
+    """Keep the families with anyone matching a compiled filter.
+    Only the matching children of a kept family are kept, but all of its parents are. The Person objects are
+    shared with the original families, not copied. Returns the families and the number of members kept."""
     filtered = []
     num_members = 0
     for fam in families:
-        filtered_members = [m for m in fam.children if m.age >= min_age]
-        if filtered_members:
-            filtered.append(Family(fam.parents, filtered_members))
-            num_members += len(filtered_members)
+        children = [c for c in fam.children if predicate(c, "child")]
+        if children or any(predicate(p, "parent") for p in fam.parents):
+            filtered.append(Family(fam.parents, children))
+            num_members += len(children)
     return filtered, num_members
 
 
-def print_table_row(heading, value, l_padding=" "*4):
-    "Prints something in HTML table row brackets"
+def filter_min_age(families, min_age):
+    "Removes entries where the member minimum age is below the threshold"
+    return filter_families(families, lambda person, relation: relation == "child" and person.age >= min_age)
+
+
+HTML_TABLE_ROW = "{padding}<tr><th>{heading}</th><td>{value}</td></tr>\n".format
+HTML_FAMILY_START = '<div class="roster_family" id="{0}"><a name="{0}"></a>\n'.format
+HTML_PERSON_HEADING = '        <tr><th colspan="2">{0.first_name} {0.last_name}</th></tr>\n'.format
+HTML_PERSON_ROLE = '        <tr><td colspan="2">{0.role}</td></tr>\n'.format
+MARKDOWN_FIELD = "{padding}- {heading}: {value}\n".format
+ROSTER_CSV_KEYS = ["Family", "Relation", "First Name", "Last Name", "Role", "Email", "Phone", "Address", "City",
+                   "Age"]
+
+
+def table_row(heading, value, l_padding=" "*4):
+    "Format something in HTML table row brackets, or nothing if there is no value"
     if value:
-        print(f"{l_padding}<tr><th>{heading}</th><td>{value}</td></tr>")
+        return HTML_TABLE_ROW(padding=l_padding, heading=heading, value=value)
+    return ""
 
 
-def roster(ods_file_name, full_html=False, member_min_age=None):
-    "Make a pretty roster out of the state 4-H Export"
-    families = get_families_from_ucnar_ods(ods_file_name)
+def render_family_html(fam):
+    "Render one family as an HTML roster entry"
+    out = [HTML_FAMILY_START(fam.family_name)]
+    indiv = fam.individual
+    if indiv:
+        out.append(f"  <h3>{indiv.last_name}, {indiv.first_name}</h3>\n")
+        if indiv.role:
+            out.append(f"  <h4>{indiv.role}</h4>\n")
+        out.append("  <table>\n")
+        out.append(table_row("Email", indiv.email))
+        out.append(table_row("Phone", indiv.phone))
+        out.append(table_row("Address", indiv.address))
+        out.append(table_row("City", indiv.city))
+        out.append("  </table>\n")
+    else:
+        family_email = fam.family_email
+        family_phone = fam.family_phone
+        out.append(f"  <h3>{fam.family_name}</h3>\n")
+        out.append("  <table>\n")
+        for email in family_email:
+            out.append(table_row("Email", email))
+        for phone in family_phone:
+            out.append(table_row("Phone", phone))
+        address = ", ".join(part or "" for part in fam.family_address)
+        out.append(table_row("Address", address))
+        out.append("  </table>\n")
+        out.append("  <table>\n")
+        out.append("    <tr><th>Adults</th><th>Children</th><td>\n")
+        out.append("      <tr><td><table>\n")
+        for adult in fam.parents:
+            out.append(HTML_PERSON_HEADING(adult))
+            if adult.role:
+                out.append(HTML_PERSON_ROLE(adult))
+            out.append(table_row("Email", adult.email if adult.email not in family_email else None, " "*8))
+            out.append(table_row("Phone", adult.phone if adult.phone not in family_phone else None, " "*8))
+        out.append("      </table></td><td><table>\n")
+        for child in fam.children:
+            out.append(HTML_PERSON_HEADING(child))
+            out.append(table_row("Email", child.email if child.email not in family_email else None, " "*8))
+            out.append(table_row("Phone", child.phone if child.phone not in family_phone else None, " "*8))
+        out.append("      </table></td></tr>\n")
+        out.append("  </table>\n")
+    out.append("</div>\n")
+    return "".join(out)
+
+
+def _markdown_field(heading, value, l_padding=""):
+    "Format a markdown list item, or nothing if there is no value"
+    if value:
+        return MARKDOWN_FIELD(padding=l_padding, heading=heading, value=value)
+    return ""
+
+
+def render_family_markdown(fam):
+    "Render one family as a Markdown roster entry"
+    indiv = fam.individual
+    if indiv:
+        out = [f"### {indiv.last_name}, {indiv.first_name}\n\n"]
+        if indiv.role:
+            out.append(f"*{indiv.role}*\n\n")
+        out.append(_markdown_field("Email", indiv.email))
+        out.append(_markdown_field("Phone", indiv.phone))
+        out.append(_markdown_field("Address", indiv.address))
+        out.append(_markdown_field("City", indiv.city))
+        out.append("\n")
+        return "".join(out)
+    family_email = fam.family_email
+    family_phone = fam.family_phone
+    out = [f"### {fam.family_name}\n\n"]
+    for email in family_email:
+        out.append(_markdown_field("Email", email))
+    for phone in family_phone:
+        out.append(_markdown_field("Phone", phone))
+    address = ", ".join(part or "" for part in fam.family_address)
+    out.append(_markdown_field("Address", address))
+    for heading, people in (("Adults", fam.parents), ("Children", fam.children)):
+        if people:
+            out.append(f"\n**{heading}**\n\n")
+        for person in people:
+            out.append(f"- {person.first_name} {person.last_name}\n")
+            out.append(_markdown_field("Role", person.role, " "*2))
+            out.append(_markdown_field("Email", person.email if person.email not in family_email else None, " "*2))
+            out.append(_markdown_field("Phone", person.phone if person.phone not in family_phone else None, " "*2))
+    out.append("\n")
+    return "".join(out)
+
+
+def render_family_csv(fam):
+    "Render one family as CSV rows, one per person"
+    out = io.StringIO()
+    writer = csv.writer(out, delimiter=",")
+    family_name = fam.family_name
+    for relation, people in (("Adult", fam.parents), ("Child", fam.children)):
+        for person in people:
+            writer.writerow([family_name, relation, person.first_name, person.last_name, person.role or "",
+                             person.email, person.phone, person.address or "", person.city or "",
+                             person.age or ""])
+    return out.getvalue()
+
+
+def person_as_dict(person):
+    "Plain dict of a person's fields"
+    return {field: getattr(person, field) for field in Person.__slots__}
+
+
+def render_family_json(fam):
+    "Render one family as a JSON object"
+    return json.dumps({"family_name": fam.family_name,
+                       "parents": [person_as_dict(p) for p in fam.parents],
+                       "children": [person_as_dict(c) for c in fam.children]})
+
+
+def _csv_header():
+    "CSV heading row for a roster"
+    out = io.StringIO()
+    csv.writer(out, delimiter=",").writerow(ROSTER_CSV_KEYS)
+    return out.getvalue()
+
+
+# Format name: (document start, family renderer, separator between families, document end)
+ROSTER_FORMATS = {
+    "html": ("", render_family_html, "", ""),
+    "markdown": ("", render_family_markdown, "", ""),
+    "csv": (_csv_header(), render_family_csv, "", ""),
+    "json": ("[\n", render_family_json, ",\n", "\n]\n"),
+}
+
+
+def iter_roster(families, fmt="html", full_html=False):
+    "Generate a roster document a chunk at a time, one chunk per family"
+    start, render_family, separator, end = ROSTER_FORMATS[fmt]
+    if fmt == "html" and full_html:
+        start, end = "<html><body>\n", "</body></html>\n"
+    if start:
+        yield start
+    for i, fam in enumerate(families):
+        chunk = render_family(fam)
+        yield separator + chunk if i and separator else chunk
+    if end:
+        yield end
+
+
+@STATS.timed("render")
+def write_roster(families, out, fmt="html", full_html=False):
+    "Write a roster document to a text stream"
+    out.writelines(iter_roster(families, fmt, full_html))
+
+
+def roster_families(ods_file_name, member_min_age=None, cache_dir=None, dedupe_report=None, member_filter=None):
+    "Load, dedupe and filter the families for a roster, sorted by family name"
+    if member_min_age and is_store(ods_file_name) and not dedupe_report:
+        # Let the store's age index do the filtering
+        families = store_families(ods_file_name, member_min_age)
+        num_members = sum(len(fam.children) for fam in families)
+    else:
+        families = load_families(ods_file_name, cache_dir)
+        if dedupe_report:
+            families = dedupe_families(families, dedupe_report)
+        if member_min_age:
+            families, num_members = filter_min_age(families, member_min_age)
     if member_min_age:
-        families, num_members = filter_min_age(families, member_min_age)
         print(f"{num_members} members in {len(families)} families after filter", file=sys.stderr)
+    if member_filter:
+        families, num_members = filter_families(families, compile_filter(member_filter))
+        print(f"{num_members} members in {len(families)} families match {member_filter}", file=sys.stderr)
     families.sort(key=lambda fam: fam.family_name)
-    if full_html:
-        print('<html><body>')
+    return families
+
+
+def roster(ods_file_name, full_html=False, member_min_age=None, cache_dir=None, fmt="html", out=None,
+           dedupe_report=None, member_filter=None):
+    "Make a pretty roster out of the state 4-H Export"
+    families = roster_families(ods_file_name, member_min_age, cache_dir, dedupe_report, member_filter)
+    write_roster(families, sys.stdout if out is None else out, fmt, full_html)
+
+
+SHARD_MANIFEST = "shards.json"
+SHARD_INDEX = "index.html"
+# Prefixed so that no shard key, such as a city called Index, can clash with the index page
+SHARD_FILE = "shard-{0}.html".format
+SHARD_PAGE_START = '<html><head><title>{0}</title></head><body>\n<p><a href="{1}">Index</a></p>\n<h2>{0}</h2>\n'.format
+
+
+def shard_initial(fam):
+    "Shard key and heading for a family by the initial of its family name"
+    initial = fam.family_name[:1].upper()
+    return (initial, initial) if initial.isalpha() else ("other", "Other")
+
+
+def shard_city(fam):
+    "Shard key and heading for a family by its city"
+    city = " ".join((fam.family_address[-1] or "").split()).title()
+    return re.sub(r"[^a-z0-9]+", "-", city.lower()).strip("-") or "unknown", city or "Unknown"
+
+
+SHARD_KEYS = {"initial": shard_initial, "city": shard_city}
+
+
+def shard_families(families, shard_by="initial"):
+    "Group families into {key: (heading, families)} shards, keeping their order within each shard"
+    shard_key = SHARD_KEYS[shard_by]
+    shards = {}
     for fam in families:
-        print('<div class="roster_family" id="{0}"><a name="{0}"></a>'.format(fam.family_name))
-        indiv = fam.individual
-        if indiv:
-            print(f"  <h3>{indiv.last_name}, {indiv.first_name}</h3>")
-            if indiv.role:
-                print(f"  <h4>{indiv.role}</h4>")
-            print("  <table>")
-            print_table_row("Email", indiv.email)
-            print_table_row("Phone", indiv.phone)
-            print_table_row("Address", indiv.address)
-            print_table_row("City", indiv.city)
-            print("  </table>")
-        else:
-            print(f"  <h3>{fam.family_name}</h3>")
-            print("  <table>")
-            for email in fam.family_email:
-                print_table_row("Email", email)
-            for phone in fam.family_phone:
-                print_table_row("Phone", phone)
-            print_table_row("Address", ", ".join(fam.family_address) if fam.family_address else None)
-            print("  </table>")
-            print("  <table>")
-            print("    <tr><th>Adults</th><th>Children</th><td>")
-            print("      <tr><td><table>")
-            for adult in fam.parents:
-                print(f'        <tr><th colspan="2">{adult.first_name} {adult.last_name}</th></tr>')
-                if adult.role:
-                    print(f'        <tr><td colspan="2">{adult.role}</td></tr>')
-                print_table_row("Email", adult.email if adult.email not in fam.family_email else None, " "*8)
-                print_table_row("Phone", adult.phone if adult.phone not in fam.family_phone else None, " "*8)
-            print("      </table></td><td><table>")
-            for child in fam.children:
-                print(f'        <tr><th colspan="2">{child.first_name} {child.last_name}</th></tr>')
-                print_table_row("Email", child.email if child.email not in fam.family_email else None, " "*8)
-                print_table_row("Phone", child.phone if child.phone not in fam.family_phone else None, " "*8)
-            print("      </table></td></tr>")
-            print("  </table>")
-        print("</div>")
-    if full_html:
-        print('</body></html>')
+        key, heading = shard_key(fam)
+        shards.setdefault(key, (heading, []))[1].append(fam)
+    return dict(sorted(shards.items(), key=lambda shard: shard[1][0]))
+
+
+def shard_digest(families):
+    "Digest of everything rendered for a shard's families, used to skip rewriting unchanged shards"
+    return hashlib.sha256(repr([(fam.family_name, family_signature(fam)) for fam in families]).encode()).hexdigest()
+
+
+def write_shard(file_name, heading, families):
+    "Write one shard of a sharded roster as a standalone HTML page"
+    with open(file_name, "wt") as out:
+        out.write(SHARD_PAGE_START(heading, SHARD_INDEX))
+        out.writelines(render_family_html(fam) for fam in families)
+        out.write("</body></html>\n")
+    return len(families)
+
+
+@STATS.timed("shards")
+def roster_shards(ods_file_name, output_dir, shard_by="initial", member_min_age=None, cache_dir=None,
+                  dedupe_report=None, member_filter=None, workers=None):
+    """Write a roster as one HTML page per family name initial or city, plus an index page linking to every family.
+    Shards are rendered on a process pool and only rewritten when their families change since the last run,
+    as recorded in shards.json in output_dir"""
+    import concurrent.futures
+    import glob
+    import urllib.parse
+    families = roster_families(ods_file_name, member_min_age, cache_dir, dedupe_report, member_filter)
+    shards = shard_families(families, shard_by)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_file = os.path.join(output_dir, SHARD_MANIFEST)
+    try:
+        with open(manifest_file, "rt") as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        manifest = {}
+    if manifest.get("shard_by") != shard_by:
+        manifest = {"shard_by": shard_by, "shards": {}}
+    previous = manifest["shards"]
+    digests = {key: shard_digest(fams) for key, (_, fams) in shards.items()}
+    stale = [key for key in shards if previous.get(key) != digests[key] or
+             not os.path.isfile(os.path.join(output_dir, SHARD_FILE(key)))]
+    # Remove every other shard page, including those of an earlier run split another way
+    wanted = {os.path.join(output_dir, SHARD_FILE(key)) for key in shards}
+    for page in glob.glob(os.path.join(glob.escape(output_dir), SHARD_FILE("*"))):
+        if page not in wanted:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(page)
+    if len(stale) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [pool.submit(write_shard, os.path.join(output_dir, SHARD_FILE(key)), *shards[key]) for key in stale]
+            for job in jobs:
+                job.result()
+    else:
+        for key in stale:
+            write_shard(os.path.join(output_dir, SHARD_FILE(key)), *shards[key])
+    with open(os.path.join(output_dir, SHARD_INDEX), "wt") as out:
+        out.write("<html><head><title>Roster</title></head><body>\n<p>")
+        out.write(" ".join(f'<a href="#{key}">{heading}</a>' for key, (heading, _) in shards.items()))
+        out.write("</p>\n")
+        for key, (heading, fams) in shards.items():
+            out.write(f'<h2 id="{key}"><a href="{SHARD_FILE(key)}">{heading}</a></h2>\n<ul>\n')
+            out.writelines(f'  <li><a href="{SHARD_FILE(key)}#{urllib.parse.quote(fam.family_name)}">'
+                           f"{fam.family_name}</a></li>\n" for fam in fams)
+            out.write("</ul>\n")
+        out.write("</body></html>\n")
+    manifest["shards"] = digests
+    with open(manifest_file, "wt") as fh:
+        json.dump(manifest, fh, indent=1, sort_keys=True)
+    STATS.count("shards_written", len(stale))
+    sys.stderr.write(f"{len(families)} families in {len(shards)} shards, {len(stale)} rewritten{os.linesep}")
+    return stale
+
+
+def person_signature(person):
+    "Tuple of all of a person's fields, used to notice changes between exports"
+    return tuple(getattr(person, field) for field in Person.__slots__)
+
+
+def family_signature(fam):
+    "Order independent summary of everyone in a family and their details"
+    return (tuple(sorted(person_signature(p) for p in fam.parents)),
+            tuple(sorted(person_signature(c) for c in fam.children)))
+
+
+def load_snapshot(file_name, cache_dir=None):
+    """Load the families and Wordpress users of a 4-H export, or of a snapshot pickle written by diff_rosters.
+    Returns (families, {email: username})"""
+    if file_name.endswith(".pickle"):
+        with open(file_name, "rb") as fh:
+            snapshot = pickle.load(fh)
+        return families_from_data(snapshot["families"]), snapshot["users"]
+    families = load_families(file_name, cache_dir)
+    return families, get_family_users(families) if is_store(file_name) else get_member_users(file_name)
+
+
+def diff_families(old_families, new_families):
+    """Compare two lists of families, matching them on the name keys of the people in them.
+    Returns lists of added and changed families from new_families and of removed families from old_families."""
+    old_index = {}
+    for fam in old_families:
+        for person in fam.parents + fam.children:
+            old_index.setdefault(FamilyBuilder.name_key(person), fam)
+    matched = set()
+    added = []
+    changed = []
+    for fam in new_families:
+        previous = {id(old_index[key]): old_index[key] for key in
+                    (FamilyBuilder.name_key(person) for person in fam.parents + fam.children) if key in old_index}
+        matched.update(previous)
+        if not previous:
+            added.append(fam)
+        elif len(previous) > 1 or family_signature(fam) != family_signature(next(iter(previous.values()))):
+            changed.append(fam)
+    removed = [fam for fam in old_families if id(fam) not in matched]
+    return added, removed, changed
+
+
+def diff_rosters(previous, current, output_dir, cache_dir=None):
+    """Write the roster fragments and the Mailchimp and Wordpress rows affected by the changes between two exports.
+    possible_add.csv and possible_remove.csv have the shape of the -m sheets, new_users.csv and remove_users.csv that
+    of the -u sheets. A snapshot of the current export is saved in output_dir for use as the next previous."""
+    old_families, old_users = load_snapshot(previous, cache_dir)
+    new_families, new_users = load_snapshot(current, cache_dir)
+    added, removed, changed = diff_families(old_families, new_families)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "roster_changes.html"), "wt") as out:
+        write_roster(sorted(added + changed, key=lambda fam: fam.family_name), out)
+    with open(os.path.join(output_dir, "roster_removed.csv"), "wt") as fh:
+        writer = csv.writer(fh, delimiter=",")
+        for fam in removed:
+            writer.writerow([fam.family_name])
+    # Emails only need to change where the affected families gained or lost them
+    old_emails = {email for fam in old_families for email in fam.all_emails}
+    new_emails = {email for fam in added + changed for email in fam.all_emails}
+    kept_emails = {email for fam in new_families for email in fam.all_emails}
+    with open(os.path.join(output_dir, "possible_add.csv"), "wt") as fh:
+        writer = csv.writer(fh, delimiter=",")
+        for fam in added + changed:
+            emails = sorted(set(fam.all_emails) - old_emails)
+            if emails:
+                writer.writerow([fam.family_name] + emails)
+    with open(os.path.join(output_dir, "possible_remove.csv"), "wt") as fh:
+        writer = csv.writer(fh, delimiter=",")
+        for email in sorted(old_emails - kept_emails):
+            writer.writerow([email])
+    with open(os.path.join(output_dir, "new_users.csv"), "wt") as fh:
+        for email, username in new_users.items():
+            if email not in old_users:
+                fh.write(f"{username}, {email}{os.linesep}")
+    with open(os.path.join(output_dir, "remove_users.csv"), "wt") as fh:
+        for email in old_users:
+            if email not in new_users:
+                fh.write(email)
+                fh.write(os.linesep)
+    with open(os.path.join(output_dir, "snapshot.pickle"), "wb") as fh:
+        pickle.dump({"families": families_to_data(new_families), "users": new_users}, fh,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    sys.stderr.write(f"{len(added)} added, {len(changed)} changed, {len(removed)} removed families, "
+                     f"{len(new_emails - old_emails)} new emails, {len(new_users.keys() - old_users.keys())} new "
+                     f"and {len(old_users.keys() - new_users.keys())} removed users{os.linesep}")
+    return added, removed, changed
 
 
+# Exports picked up from a batch or served directory, CSV files there are Mailchimp exports
+SPREADSHEET_EXTENSIONS = (".ods", ".xlsx", ".xlsm")
+BATCH_REPORT_KEYS = ["Club", "Families", "Members", "Adults", "Possible Add", "Possible Remove", "Seconds"]
+
+
+def get_batch_clubs(source):
+    """List (club, 4-H export, Mailchimp export or None) for a batch run.
+    `source` is either a directory of ODS or Excel exports, with optional Mailchimp exports named <club>.csv
+    beside them, or a CSV manifest with Club, Export and optional Mailchimp columns. Manifest paths are relative
+    to it."""
+    if os.path.isdir(source):
+        clubs = []
+        for name in sorted(os.listdir(source)):
+            club, ext = os.path.splitext(name)
+            if ext.lower() in SPREADSHEET_EXTENSIONS:
+                mailchimp = os.path.join(source, club + ".csv")
+                clubs.append((club, os.path.join(source, name), mailchimp if os.path.isfile(mailchimp) else None))
+        return clubs
+    base = os.path.dirname(source)
+    with open(source, "rt") as fh:
+        return [(row["Club"], os.path.join(base, row["Export"]),
+                 os.path.join(base, row["Mailchimp"]) if row.get("Mailchimp") else None)
+                for row in csv.DictReader(fh) if row.get("Club")]
+
+
+def batch_club(club, export, mailchimp, output_dir, strict=False, member_min_age=None, cache_dir=None):
+    "Produce the roster and Mailchimp sheets for one club of a batch run, returning its report row"
+    start = time.perf_counter()
+    club_dir = os.path.join(output_dir, club)
+    os.makedirs(club_dir, exist_ok=True)
+    families = load_families(export, cache_dir)
+    possible_add = possible_rm = ""
+    if mailchimp:
+        with open(mailchimp, "rt") as mailchimp_export:
+            possible_rm, possible_add = merge_families(families, mailchimp_export, strict, club_dir)
+        possible_add = len(possible_add)
+    if member_min_age:
+        families, _ = filter_min_age(families, member_min_age)
+    families.sort(key=lambda fam: fam.family_name)
+    with open(os.path.join(club_dir, "roster.html"), "wt") as out:
+        write_roster(families, out, full_html=True)
+    return [club, len(families), sum(len(fam.children) for fam in families),
+            sum(len(fam.parents) for fam in families), possible_add, possible_rm,
+            round(time.perf_counter() - start, 3)]
+
+
+def batch(source, output_dir, strict=False, member_min_age=None, cache_dir=None, workers=None):
+    "Process many club exports on a process pool and write a council report"
+    import concurrent.futures
+    clubs = get_batch_clubs(source)
+    os.makedirs(output_dir, exist_ok=True)
+    report = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = {pool.submit(batch_club, club, export, mailchimp, output_dir, strict, member_min_age, cache_dir): club
+                for club, export, mailchimp in clubs}
+        for job in concurrent.futures.as_completed(jobs):
+            try:
+                row = job.result()
+            except Exception as err:
+                sys.stderr.write(f"{jobs[job]}: failed: {err}{os.linesep}")
+                continue
+            sys.stderr.write(f"{row[0]}: {row[1]} families in {row[-1]:.3f}s{os.linesep}")
+            report.append(row)
+    report.sort()
+    with open(os.path.join(output_dir, "council_report.csv"), "wt") as fh:
+        writer = csv.writer(fh, delimiter=",")
+        writer.writerow(BATCH_REPORT_KEYS)
+        writer.writerows(report)
+        writer.writerow(["Total"] + [round(sum(row[i] for row in report if row[i] != ""), 3)
+                                     for i in range(1, len(BATCH_REPORT_KEYS))])
+    return report
+
+
+# Columns of the Members sheet that Wordpress accounts are made from
+MEMBER_USER_COLUMNS = ("Family: Family Email", "Member: Last Name")
+
+
+def get_member_users(members):
+    """Map family emails to the usernames Wordpress accounts are made with, the member last name.
+    `members` is a 4-H export or a members CSV with the same columns. Only the Members sheet is streamed"""
+    users = {}
+    rows = (row for sheet_name, row in iter_rows(members, {"Members": MEMBER_USER_COLUMNS})
+            if sheet_name == "Members")
+    keys = keys_row_to_keys_dict(next(rows, []))
+    for row in rows:
+        email = normalize_email(str(get_cell(row, keys, "Family: Family Email")))
+        if email:
+            users[email] = str(get_cell(row, keys, "Member: Last Name"))
+    return users
+
+
+def get_family_users(families):
+    """Map emails to Wordpress usernames from a list of families, for inputs without a Members sheet.
+    Each parent's email is paired with the last name of the first child in their family"""
+    users = {}
+    for fam in families:
+        if fam.children:
+            for parent in fam.parents:
+                if parent.email:
+                    users.setdefault(parent.email, fam.children[0].last_name)
+    return users
+
+
+def stream_wordpress_removes(wordpress_export, known_emails, remove_file):
+    """Stream a Wordpress user export, writing the addresses not in known_emails to remove_file one per line.
+    Only the sets of user emails and lowercase usernames are kept, which are returned"""
+    wp_emails = set()
+    wp_usernames = set()
+    for (email, username), _ in iter_csv_columns(wordpress_export, ["Email", "Choose a Username"]):
+        email = normalize_email(email)
+        wp_usernames.add(username.lower())
+        if email in wp_emails:
+            continue
+        wp_emails.add(email)
+        if email not in known_emails:
+            remove_file.write(email)
+            remove_file.write(os.linesep)
+    return wp_emails, wp_usernames
+
+
+def new_wordpress_users(users, wp_emails, wp_usernames):
+    "List (username, email) for the member users that have no Wordpress account by email or username"
+    return [(username, email) for email, username in users.items()
+            if email not in wp_emails and username.lower() not in wp_usernames]
+
+
+@STATS.timed("wordpress_reconcile")
 def user_update(wp_users, members, new_users, remove_users):
     """Accepts a CSV of current WP users, a CSV of current club members
     Outputs two new CSVs, one of users to be added, and one of users to remove"""
-    with open(wp_users, "rt") as fh:
-        wp_keys, wp_users = get_wordpress_data(fh)
-        wp_username_col = wp_keys.index("Choose a Username")
-        wp_usernames = [user[wp_username_col].lower() for user in wp_users.values()]
-    with open(members, "rt") as fh:
-        roster_keys, roster_users = get_members_and_adults_from_csv(fh)
-    new_emails = [em for em in roster_users.keys() if em not in wp_users.keys()]
-    remove_emails = [em for em in wp_users.keys() if em not in roster_users.keys()]
+    roster_users = get_member_users(members)
+    with open(wp_users, "rt") as fh, open(remove_users, "wt") as out:
+        wp_emails, wp_usernames = stream_wordpress_removes(fh, roster_users, out)
     with open(new_users, "wt") as fh:
-        for em in new_emails:
-            username = roster_users[em][roster_keys.index("Member: Last Name")]
-            if username.lower() not in wp_usernames:
-                fh.write(f"{username}, {em}{os.linesep}")
-    with open(remove_users, "wt") as fh:
-        for em in remove_emails:
-            fh.write(em)
-            fh.write(os.linesep)
+        for username, em in new_wordpress_users(roster_users, wp_emails, wp_usernames):
+            fh.write(f"{username}, {em}{os.linesep}")
+
+
+def build_email_index(families):
+    "Index the people in a list of families by email, as lists of (family, person) pairs"
+    index = {}
+    for fam in families:
+        for person in fam.parents + fam.children:
+            if person.email:
+                index.setdefault(person.email, []).append((fam, person))
+    return index
+
+
+@STATS.timed("reconcile")
+def reconcile(roster_input, mailchimp_export, wordpress_export, strict=False, cache_dir=None, output_dir=".",
+              dedupe_report=None):
+    """Reconcile a 4-H export against both Mailchimp and Wordpress at once.
+    Writes possible_add.csv and possible_remove.csv for Mailchimp and new_users.csv and remove_users.csv for
+    Wordpress into output_dir. The Mailchimp and Wordpress exports are streamed, keeping only their addresses
+    and usernames. Wordpress users are matched on family email and member last name as for user_update, or for a
+    roster store on the parents' emails, see get_family_users"""
+    families = load_families(roster_input, cache_dir)
+    if dedupe_report:
+        families = dedupe_families(families, dedupe_report)
+    index = build_email_index(families)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "possible_remove.csv"), "wt") as fh:
+        mailchimp_emails = stream_mailchimp_removes(mailchimp_export, index, csv.writer(fh, delimiter=","))
+    if is_store(roster_input):
+        users = get_family_users(families)
+    else:
+        users = get_member_users(roster_input)
+    with open(os.path.join(output_dir, "remove_users.csv"), "wt") as fh:
+        wp_emails, wp_usernames = stream_wordpress_removes(wordpress_export, users, fh)
+    new_users = new_wordpress_users(users, wp_emails, wp_usernames)
+    subscribed = set()
+    unsubscribed = set()
+    for email, people in index.items():
+        for fam, _ in people:
+            (subscribed if email in mailchimp_emails else unsubscribed).add(fam)
+    if strict:
+        possible_add = [fam for fam in families if fam in unsubscribed]
+    else:
+        possible_add = [fam for fam in families if fam not in subscribed]
+    with open(os.path.join(output_dir, "possible_add.csv"), "wt") as fh:
+        writer = csv.writer(fh, delimiter=",")
+        for fam in possible_add:
+            writer.writerow([fam.family_name] + list(set(fam.all_emails)))
+    with open(os.path.join(output_dir, "new_users.csv"), "wt") as fh:
+        for username, email in new_users:
+            fh.write(f"{username}, {email}{os.linesep}")
+    return possible_add, len(mailchimp_emails - index.keys()), new_users, len(wp_emails - users.keys())
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                500: "Internal Server Error"}
+# Query parameters of a roster request, anything else is ignored and not part of the response cache key
+SERVER_ROSTER_PARAMS = ("format", "age", "filter", "full")
+
+
+class RosterServer:
+    """Keeps the families of every club export in a directory parsed in memory and serves rosters and Mailchimp
+    sheets over HTTP. Exports are found the same way as for --batch and re-parsed only when their files change.
+
+    GET /                                      index of clubs
+    GET /<club>/roster?format=html&age=9&filter=city=="Pasadena"&full=1
+                                               roster, format, age and filter expression optional
+    GET /<club>/possible_add                   Mailchimp possible add CSV
+    GET /<club>/possible_remove                Mailchimp possible remove CSV
+    """
+
+    def __init__(self, directory, strict=False, cache_dir=None, poll_interval=5.0):
+        "Initalize server state, nothing is loaded until serve is called"
+        self.directory = directory
+        self.strict = strict
+        self.cache_dir = cache_dir
+        self.poll_interval = poll_interval
+        # club: (file modification times, families, Mailchimp export path)
+        self.clubs = {}
+        # (club, path, recognized query items): (content type, body), cleared for a club when it is reloaded
+        self.responses = {}
+
+    @staticmethod
+    def _mtimes(*paths):
+        "Modification times of files, None for missing ones"
+        return tuple(os.stat(path).st_mtime_ns if path and os.path.exists(path) else None for path in paths)
+
+    async def refresh(self):
+        "Parse any club export that is new or changed since the last refresh and forget removed ones"
+        import asyncio
+        loop = asyncio.get_running_loop()
+        found = {club: (export, mailchimp) for club, export, mailchimp in get_batch_clubs(self.directory)}
+        for club in set(self.clubs) - set(found):
+            del self.clubs[club]
+            self._forget(club)
+        for club, (export, mailchimp) in found.items():
+            mtimes = self._mtimes(export, mailchimp)
+            if club in self.clubs and self.clubs[club][0] == mtimes:
+                continue
+            try:
+                families = await loop.run_in_executor(None, load_families, export, self.cache_dir)
+            except Exception as err:
+                sys.stderr.write(f"{club}: failed to load {export}: {err}{os.linesep}")
+                continue
+            self.clubs[club] = (mtimes, families, mailchimp)
+            self._forget(club)
+            sys.stderr.write(f"{club}: loaded {len(families)} families{os.linesep}")
+
+    def _forget(self, club):
+        "Drop cached responses for a club"
+        for key in [key for key in self.responses if key[0] == club]:
+            del self.responses[key]
+
+    async def watch(self):
+        "Refresh forever"
+        import asyncio
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            await self.refresh()
+
+    def _index(self):
+        "HTML index of the clubs being served"
+        links = "".join(f'<li><a href="/{club}/roster?full=1">{club}</a></li>' for club in sorted(self.clubs))
+        return "text/html", f"<html><body><ul>{links}</ul></body></html>"
+
+    def _roster(self, families, query):
+        "Roster of a club's families"
+        fmt = query.get("format", "html")
+        if fmt not in ROSTER_FORMATS:
+            raise ValueError(f"Unknown format {fmt!r}")
+        if query.get("age"):
+            families, _ = filter_min_age(families, int(query["age"]))
+        if query.get("filter"):
+            families, _ = filter_families(families, compile_filter(query["filter"]))
+        out = io.StringIO()
+        write_roster(sorted(families, key=lambda fam: fam.family_name), out, fmt, bool(query.get("full")))
+        content_type = {"html": "text/html", "markdown": "text/markdown", "csv": "text/csv",
+                        "json": "application/json"}[fmt]
+        return content_type, out.getvalue()
+
+    def _mailchimp(self, families, mailchimp, view):
+        "Mailchimp possible add or remove sheet for a club"
+        known_emails = {email for fam in families for email in fam.all_emails}
+        removes = io.StringIO()
+        with open(mailchimp, "rt") as fh:
+            mailchimp_emails = stream_mailchimp_removes(fh, known_emails, csv.writer(removes, delimiter=","))
+        if view == "possible_remove":
+            return "text/csv", removes.getvalue()
+        out = io.StringIO()
+        writer = csv.writer(out, delimiter=",")
+        for fam in missing_from_mailchimp(mailchimp_emails, families, self.strict):
+            writer.writerow([fam.family_name] + list(set(fam.all_emails)))
+        return "text/csv", out.getvalue()
+
+    def respond(self, path, query):
+        "Content type and body for a request, raising KeyError for unknown paths"
+        if path in ("", "/"):
+            return self._index()
+        club, _, view = path.strip("/").partition("/")
+        params = () if view != "roster" else \
+            tuple((name, query[name]) for name in SERVER_ROSTER_PARAMS if name in query)
+        key = (club, view, params)
+        if key in self.responses:
+            return self.responses[key]
+        _, families, mailchimp = self.clubs[club]
+        if view == "roster":
+            response = self._roster(families, query)
+        elif view in ("possible_add", "possible_remove") and mailchimp:
+            response = self._mailchimp(families, mailchimp, view)
+        else:
+            raise KeyError(path)
+        self.responses[key] = response
+        return response
+
+    async def handle(self, reader, writer):
+        "Answer one HTTP request"
+        import urllib.parse
+        try:
+            request = (await reader.readline()).decode("latin-1").split()
+            while (await reader.readline()).strip():
+                pass
+            if len(request) < 2:
+                status, content_type, body = 400, "text/plain", "Bad request"
+            elif request[0] != "GET":
+                status, content_type, body = 405, "text/plain", "Only GET is supported"
+            else:
+                url = urllib.parse.urlsplit(request[1])
+                query = dict(urllib.parse.parse_qsl(url.query))
+                try:
+                    content_type, body = self.respond(urllib.parse.unquote(url.path), query)
+                    status = 200
+                except KeyError:
+                    status, content_type, body = 404, "text/plain", "Not found"
+                except ValueError as err:
+                    status, content_type, body = 400, "text/plain", str(err)
+                except Exception as err:
+                    sys.stderr.write(f"{request[1]}: {type(err).__name__}: {err}{os.linesep}")
+                    status, content_type, body = 500, "text/plain", HTTP_REASONS[500]
+            data = body.encode()
+            writer.write(f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                         f"Content-Type: {content_type}; charset=utf-8\r\n"
+                         f"Content-Length: {len(data)}\r\n"
+                         "Connection: close\r\n\r\n".encode() + data)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8044):
+        "Load the exports and serve until cancelled"
+        import asyncio
+        await self.refresh()
+        server = await asyncio.start_server(self.handle, host, port)
+        sys.stderr.write(f"Serving {self.directory} on http://{host}:{port}/{os.linesep}")
+        async with server:
+            await asyncio.gather(server.serve_forever(), self.watch())
+
+
+MAILCHIMP_BATCH_SIZE = 500
+MAILCHIMP_RETRY_STATUS = (429, 500, 502, 503, 504)
+# Batch subscribe error for addresses already in the audience, whose status is left as it is
+MAILCHIMP_EXISTS_ERROR = "ERROR_CONTACT_EXISTS"
+# Idle pooled connections older than this are closed rather than reused, servers drop them soon after
+MAILCHIMP_IDLE_SECONDS = 5.0
+
+
+class ConnectionClosedError(ConnectionError):
+    "The server closed a connection before starting to answer a request on it"
+
+
+class MailchimpClient:
+    """Minimal asyncio Mailchimp marketing API client for keeping an audience in sync.
+    Requests share a pool of keep-alive connections, at most `concurrency` of them in flight at once, and are
+    retried with exponential backoff on rate limiting, server errors and dropped connections.
+    `base_url` defaults to the API server for the key's data center, but can point at a stand-in server."""
+
+    def __init__(self, api_key, list_id, base_url=None, concurrency=8, retries=5, backoff=0.5,
+                 batch_size=MAILCHIMP_BATCH_SIZE):
+        "Initalize client, no connections are made until the first request"
+        import urllib.parse
+        if base_url is None:
+            base_url = f"https://{api_key.rpartition('-')[2]}.api.mailchimp.com/3.0"
+        url = urllib.parse.urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = url.scheme == "https"
+        self.prefix = url.path.rstrip("/")
+        self.auth = base64.b64encode(f"rostermangler:{api_key}".encode()).decode()
+        self.list_id = list_id
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self._idle = []
+        self._slots = None
+
+    async def _open(self):
+        "An idle pooled connection, or a new one, as (reader, writer, whether it was reused)"
+        import asyncio
+        while self._idle:
+            reader, writer, released = self._idle.pop()
+            if time.monotonic() - released < MAILCHIMP_IDLE_SECONDS:
+                return reader, writer, True
+            writer.close()
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None) + (False,)
+
+    async def _exchange(self, reader, writer, method, path, body):
+        "Send one request on a connection and read the response, returning status, headers and body"
+        data = b"" if body is None else json.dumps(body).encode()
+        try:
+            writer.write(f"{method} {self.prefix}{path} HTTP/1.1\r\n"
+                         f"Host: {self.host}\r\n"
+                         f"Authorization: Basic {self.auth}\r\n"
+                         "Content-Type: application/json\r\n"
+                         f"Content-Length: {len(data)}\r\n"
+                         "Connection: keep-alive\r\n\r\n".encode() + data)
+            await writer.drain()
+            status_line = await reader.readline()
+        except OSError as err:
+            raise ConnectionClosedError(str(err)) from err
+        if not status_line:
+            raise ConnectionClosedError("Connection closed by server")
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b"".join(chunks)
+        else:
+            content = await reader.readexactly(int(headers.get("content-length", "0")))
+        return status, headers, content
+
+    async def request(self, method, path, body=None):
+        "Make an API request, retrying when worthwhile, and return the status and decoded JSON body"
+        import asyncio
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            attempt = -1
+            while attempt < self.retries:
+                attempt += 1
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+                try:
+                    reader, writer, reused = await self._open()
+                except OSError:
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                try:
+                    status, headers, content = await self._exchange(reader, writer, method, path, body)
+                except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError) as err:
+                    writer.close()
+                    if reused and isinstance(err, ConnectionClosedError):
+                        # The server dropped the idle connection, try again at once on another without counting it
+                        attempt -= 1
+                        continue
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(delay)
+                    continue
+                if headers.get("connection", "").lower() == "close":
+                    writer.close()
+                else:
+                    self._idle.append((reader, writer, time.monotonic()))
+                if status in MAILCHIMP_RETRY_STATUS and attempt < self.retries:
+                    retry_after = headers.get("retry-after", "")
+                    await asyncio.sleep(float(retry_after) if retry_after.isdigit() else delay)
+                    continue
+                try:
+                    return status, json.loads(content) if content else None
+                except ValueError:
+                    raise ValueError(f"HTTP {status} response is not JSON") from None
+
+    @staticmethod
+    def subscriber_hash(email):
+        "Mailchimp's id for an audience member"
+        return hashlib.md5(normalize_email(email).encode()).hexdigest()
+
+    async def subscribe(self, emails):
+        """Subscribe new addresses in batches, returning the count added and a list of errors.
+        Addresses already in the audience are left alone, so anyone who unsubscribed stays unsubscribed"""
+        import asyncio
+        batches = [emails[i:i + self.batch_size] for i in range(0, len(emails), self.batch_size)]
+        results = await asyncio.gather(*(
+            self.request("POST", f"/lists/{self.list_id}",
+                         {"members": [{"email_address": email, "status": "subscribed"} for email in batch],
+                          "update_existing": False})
+            for batch in batches), return_exceptions=True)
+        done = 0
+        errors = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                errors += [f"{email}: {result}" for email in batch]
+                continue
+            status, body = result
+            body = body or {}
+            if status >= 400:
+                errors += [f"{email}: {body.get('detail', f'HTTP {status}')}" for email in batch]
+                continue
+            done += body.get("total_created", 0)
+            errors += [f"{e.get('email_address')}: {e.get('error')}" for e in body.get("errors", [])
+                       if e.get("error_code") != MAILCHIMP_EXISTS_ERROR]
+        return done, errors
+
+    async def archive(self, emails):
+        "Archive addresses from the audience, returning the count removed and a list of errors"
+        import asyncio
+        results = await asyncio.gather(*(
+            self.request("DELETE", f"/lists/{self.list_id}/members/{self.subscriber_hash(email)}")
+            for email in emails), return_exceptions=True)
+        done = 0
+        errors = []
+        for email, result in zip(emails, results):
+            if isinstance(result, Exception):
+                errors.append(f"{email}: {result}")
+                continue
+            status, body = result
+            if status < 300 or status == 404:
+                done += 1
+            else:
+                errors.append(f"{email}: {(body or {}).get('detail', f'HTTP {status}')}")
+        return done, errors
+
+    async def sync(self, adds, removes):
+        "Subscribe and archive addresses concurrently, returning (added, removed, errors)"
+        import asyncio
+        try:
+            (added, add_errors), (removed, remove_errors) = await asyncio.gather(self.subscribe(adds),
+                                                                                 self.archive(removes))
+        finally:
+            self.close()
+        return added, removed, add_errors + remove_errors
+
+    def close(self):
+        "Close pooled connections"
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+def read_merge_sheets(output_dir="."):
+    "Read the addresses to add and remove from the possible_add.csv and possible_remove.csv written by -m"
+    adds = []
+    for row in read_csv_rows(os.path.join(output_dir, "possible_add.csv")):
+        adds += [normalize_email(email) for email in row[1:] if email.strip()]
+    removes = [normalize_email(row[0]) for row in read_csv_rows(os.path.join(output_dir, "possible_remove.csv"))
+               if row and row[0].strip()]
+    return list(dict.fromkeys(adds)), list(dict.fromkeys(removes))
+
+
+@STATS.timed("mailchimp_sync")
+def mailchimp_sync(api_key, list_id, output_dir=".", base_url=None, concurrency=8):
+    "Push the addresses in the possible add and remove sheets to a Mailchimp audience"
+    import asyncio
+    adds, removes = read_merge_sheets(output_dir)
+    client = MailchimpClient(api_key, list_id, base_url, concurrency)
+    added, removed, errors = asyncio.run(client.sync(adds, removes))
+    for error in errors:
+        sys.stderr.write(f"Mailchimp: {error}{os.linesep}")
+    sys.stderr.write(f"Mailchimp: {added} of {len(adds)} subscribed, {removed} of {len(removes)} archived"
+                     f"{os.linesep}")
+    return added, removed, errors
 
 
 def main():
@@ -469,17 +2397,99 @@ def main():
     parser.add_argument("-m", "--merge", nargs=2, help="Merge state 4-H export and Mailchimp Export")
     parser.add_argument("-r", "--roster", help="Make a pretty roster out of the state 4-H Export")
     parser.add_argument("-b", "--html", action="store_true", help="Wrap output in full HTML")
+    parser.add_argument("-f", "--format", choices=sorted(ROSTER_FORMATS), default="html", help="Roster output format")
     parser.add_argument("-s", "--strict", action="store_true", help="Make sure everyone in a family is subscribed to newsletter")
     parser.add_argument("--age_filter", type=int, help="Filter roster to only members over given age.")
+    parser.add_argument("--filter", help='Filter roster by an expression like: '
+                        'age>=9 and city=="Pasadena" and role~"Leader"')
+    parser.add_argument("--shard", metavar="OUTPUT_DIR",
+                        help="Write the -r roster as one HTML page per shard plus an index page into OUTPUT_DIR, "
+                        "rewriting only the shards whose families changed")
+    parser.add_argument("--shard_by", choices=sorted(SHARD_KEYS), default="initial",
+                        help="Split a --shard roster by family name initial or by city")
     parser.add_argument("-u", "--users", nargs=4, help="Accept current WP user list, latest membership"
                         "and generate add and remove sheets")
+    parser.add_argument("--batch", nargs=2, metavar=("SOURCE", "OUTPUT_DIR"),
+                        help="Process every club export in a directory or manifest CSV into OUTPUT_DIR")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of processes for --batch and --shard, default all cores")
+    parser.add_argument("--dedupe", metavar="REPORT",
+                        help="Merge likely duplicate people for -r, -m and --reconcile and write a review CSV")
+    parser.add_argument("--reconcile", nargs=4, metavar=("EXPORT", "MAILCHIMP", "WORDPRESS", "OUTPUT_DIR"),
+                        help="Make the Mailchimp and Wordpress add and remove sheets for a 4-H export in one pass")
+    parser.add_argument("--diff", nargs=3, metavar=("PREVIOUS", "CURRENT", "OUTPUT_DIR"),
+                        help="Write only the roster entries and Mailchimp and Wordpress rows changed between two "
+                        "exports. PREVIOUS may be a snapshot.pickle from an earlier --diff")
+    parser.add_argument("--serve", metavar="DIRECTORY",
+                        help="Serve rosters and Mailchimp sheets for the club exports in DIRECTORY over local HTTP")
+    parser.add_argument("--port", type=int, default=8044, help="Port for --serve")
+    parser.add_argument("--store_import", nargs=2, metavar=("EXPORT", "STORE"),
+                        help="Add or update the families of a 4-H export in a SQLite roster store. A store can then be "
+                        "given in place of an export to -r, -m and --reconcile")
+    parser.add_argument("--club", default="", help="Club of the export for --store_import")
+    parser.add_argument("--store_find", nargs=3, metavar=("STORE", "FIELD", "VALUE"),
+                        help="List people in a roster store by " + ", ".join(STORE_SEARCH_FIELDS))
+    parser.add_argument("--mailchimp_sync", metavar="LIST_ID",
+                        help="After -m, subscribe and archive the possible add and remove addresses in this Mailchimp "
+                        "audience. The API key is read from MAILCHIMP_API_KEY")
+    parser.add_argument("--mailchimp_url", help="Mailchimp API base URL, for testing against a stand in server")
+    parser.add_argument("--profile", action="store_true", help="Print time spent in each stage and counters to stderr")
+    parser.add_argument("--stats_json", help="Write per stage timings and counters to a JSON file")
+    parser.add_argument("--cache_dir", default=CACHE_DIR, help="Directory for cached parses of 4-H exports")
+    parser.add_argument("--no_cache", action="store_true", help="Always parse the 4-H export")
     args = parser.parse_args()
+    if args.mailchimp_sync and not args.merge:
+        parser.error("--mailchimp_sync needs -m")
+    if args.mailchimp_sync and not os.environ.get("MAILCHIMP_API_KEY"):
+        parser.error("--mailchimp_sync needs the Mailchimp API key in MAILCHIMP_API_KEY")
+    if args.filter:
+        try:
+            compile_filter(args.filter)
+        except ValueError as err:
+            parser.error(str(err))
+    if args.store_find:
+        try:
+            store_find_condition(*args.store_find[1:])
+        except ValueError as err:
+            parser.error(str(err))
+    cache_dir = None if args.no_cache else args.cache_dir
+    STATS.enabled = args.profile or bool(args.stats_json)
+    if args.store_import:
+        store_import(args.store_import[1], load_families(args.store_import[0], cache_dir), args.club)
+    if args.store_find:
+        writer = csv.writer(sys.stdout, delimiter=",")
+        for family_name, person in store_find(*args.store_find):
+            writer.writerow([family_name] + [getattr(person, f) or "" for f in STORE_FIELDS])
     if args.merge:
-        roster_merge(args.merge[0], open(args.merge[1], 'rt'), args.strict)
-    if args.roster:
-        roster(args.roster, args.html, args.age_filter)
+        roster_merge(args.merge[0], open(args.merge[1], 'rt'), args.strict, cache_dir, dedupe_report=args.dedupe)
+        if args.mailchimp_sync:
+            mailchimp_sync(os.environ["MAILCHIMP_API_KEY"], args.mailchimp_sync, base_url=args.mailchimp_url)
+    if args.roster and args.shard:
+        roster_shards(args.roster, args.shard, args.shard_by, args.age_filter, cache_dir, args.dedupe, args.filter,
+                      args.jobs)
+    elif args.roster:
+        roster(args.roster, args.html, args.age_filter, cache_dir, args.format, dedupe_report=args.dedupe,
+               member_filter=args.filter)
     if args.users:
         user_update(*args.users)
+    if args.reconcile:
+        with open(args.reconcile[1], "rt") as mailchimp_export, open(args.reconcile[2], "rt") as wordpress_export:
+            reconcile(args.reconcile[0], mailchimp_export, wordpress_export, args.strict, cache_dir,
+                      args.reconcile[3], args.dedupe)
+    if args.diff:
+        diff_rosters(*args.diff, cache_dir)
+    if args.batch:
+        batch(args.batch[0], args.batch[1], args.strict, args.age_filter, cache_dir, args.jobs)
+    if args.serve:
+        import asyncio
+        try:
+            asyncio.run(RosterServer(args.serve, args.strict, cache_dir).serve(port=args.port))
+        except KeyboardInterrupt:
+            pass
+    if args.profile:
+        sys.stderr.write(STATS.summary())
+    if args.stats_json:
+        with open(args.stats_json, "wt") as fh:
+            json.dump(STATS.as_dict(), fh, indent=2)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,57 @@
+"Regression checks for rostermangler, run with pytest"
+import rostermangler
+
+
+def garcia_family(parent, child_age):
+    "A Garcia family with one named parent and a child named Alex"
+    return rostermangler.Family([rostermangler.Person(parent, "Garcia")],
+                                [rostermangler.Person("Alex", "Garcia", age=child_age)])
+
+
+def names(fam):
+    "Sorted first names and ages of everyone in a family"
+    return sorted((p.first_name, p.age) for p in fam.parents + fam.children)
+
+
+def test_store_keeps_same_named_people_apart(tmp_path):
+    "People with the same name in different families or clubs are not merged in the store"
+    store = str(tmp_path / "roster.db")
+    rostermangler.store_import(store, [garcia_family("Maria", 10), garcia_family("Jose", 12)], club="A")
+    families = rostermangler.store_families(store)
+    assert sorted(names(fam) for fam in families) == [[("Alex", 10), ("Maria", 0)], [("Alex", 12), ("Jose", 0)]]
+    # A child in another club with the same name as a club A parent stays in their own family
+    other = rostermangler.Family([rostermangler.Person("Luis", "Garcia")],
+                                 [rostermangler.Person("Maria", "Garcia", age=9)])
+    rostermangler.store_import(store, [other], club="B")
+    assert sorted(names(fam) for fam in rostermangler.store_families(store, club="A")) == \
+        [[("Alex", 10), ("Maria", 0)], [("Alex", 12), ("Jose", 0)]]
+    assert [names(fam) for fam in rostermangler.store_families(store, club="B")] == [[("Luis", 0), ("Maria", 9)]]
+    # Importing club A again updates its families in place
+    rostermangler.store_import(store, [garcia_family("Maria", 11), garcia_family("Jose", 12)], club="A")
+    assert sorted(names(fam) for fam in rostermangler.store_families(store, club="A")) == \
+        [[("Alex", 11), ("Maria", 0)], [("Alex", 12), ("Jose", 0)]]
+
+
+def test_filter_text_and_numbers():
+    "Filters match non-ASCII text and only compare numbers with numeric fields"
+    person = rostermangler.Person("Ana", "Ruiz", city="La Cañada", age=10, role='Says "hi"')
+    assert rostermangler.compile_filter('city=="La Cañada" and age>=9')(person, "child")
+    assert rostermangler.compile_filter(r'role~"\"hi\""')(person, "child")
+    for text in ("city>5", "age~5"):
+        try:
+            rostermangler.compile_filter(text)
+        except ValueError:
+            continue
+        raise AssertionError(f"{text} should not compile")
+
+
+def test_dedupe_folds_children_of_joined_families():
+    "A household split by a parent's nickname is joined without listing its children twice"
+    bob = rostermangler.Family([rostermangler.Person("Bob", "Smith", phone="626-555-1234")],
+                               [rostermangler.Person("Amy", "Smith", age=10)])
+    robert = rostermangler.Family([rostermangler.Person("Robert", "Smith", phone="626-555-1234")],
+                                  [rostermangler.Person("Amy", "Smith", age=10, email="amy@example.com")])
+    families = rostermangler.dedupe_families([bob, robert])
+    assert len(families) == 1
+    assert [p.first_name for p in families[0].parents] == ["Bob"]
+    assert [(c.first_name, c.email) for c in families[0].children] == [("Amy", "amy@example.com")]